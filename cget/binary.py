@@ -0,0 +1,80 @@
+import os, json, hashlib, tarfile, threading
+
+from cget import __version__
+from cget.cache import ArchiveCache
+import cget.util as util
+
+__COMPILER_IDS__ = {}
+__COMPILER_LOCK__ = threading.Lock()
+
+def get_compiler_id(compiler):
+    exe = util.which(compiler, throws=False)
+    if exe is None: return None
+    with __COMPILER_LOCK__:
+        if exe not in __COMPILER_IDS__:
+            try:
+                version = util.subprocess.check_output([exe, '--version'], stderr=util.subprocess.STDOUT).decode('utf-8', 'replace')
+            except (OSError, util.subprocess.CalledProcessError):
+                version = None
+            __COMPILER_IDS__[exe] = [exe, version]
+        return __COMPILER_IDS__[exe]
+
+def get_compilers():
+    return [os.environ.get('CC') or 'cc', os.environ.get('CXX') or 'c++']
+
+def hash_file(f):
+    if f is None or not os.path.isfile(f): return None
+    return util.hash_file(f, 'sha256')
+
+def get_fingerprint(source_key, pb, toolchain, requirements=None):
+    data = {
+        'version': __version__,
+        'source': source_key,
+        'define': list(pb.define),
+        'variant': pb.variant,
+        'cmake': hash_file(pb.cmake),
+        'requirements': hash_file(requirements),
+        'toolchain': hash_file(toolchain),
+        'compilers': [get_compiler_id(c) for c in get_compilers()]
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_manifest(f):
+    if not os.path.isfile(f): return None
+    with open(f) as fp:
+        return [line.strip() for line in fp if line.strip()]
+
+
+class BinaryCache(ArchiveCache):
+    def __init__(self, path, max_size=None, remote=None):
+        ArchiveCache.__init__(self, path, max_size=max_size)
+        self.remote = remote
+
+    def pull(self, key):
+        with util.staging_dir(self.get_path(key)) as temp_dir:
+            f = self.remote.download(key, temp_dir)
+            if f is None: return None
+            return self.add(key, f)
+
+    def restore(self, key, prefix, prepare=None):
+        f = self.get(key)
+        if f is None and self.remote is not None: f = self.pull(key)
+        if f is None: return None
+        with tarfile.open(f) as ar:
+            files = [os.path.join(prefix, m.name) for m in ar if not m.isdir()]
+        if prepare: prepare(files)
+        util.extract_ar(f, prefix)
+        return files
+
+    def save(self, key, files, prefix):
+        files = [f for f in files if os.path.lexists(f)]
+        # Files installed outside of the prefix can't be restored elsewhere
+        if not files or any(os.path.relpath(f, prefix).startswith(os.pardir) for f in files): return None
+        with util.staging_dir(self.get_path(key)) as temp_dir:
+            ar = os.path.join(temp_dir, 'install.tar.gz')
+            with tarfile.open(ar, 'w:gz') as f:
+                for file in files: f.add(file, arcname=os.path.relpath(file, prefix), recursive=False)
+            result = self.add(key, ar)
+        # Uploading happens in the background so the install isn't held up
+        if self.remote is not None: self.remote.upload_async(key, result)
+        return result
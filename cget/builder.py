@@ -1,5 +1,22 @@
-import click, os, multiprocessing
+import click, os, hashlib, json
 import cget.util as util
+import cget.seed as seed
+import cget.cmake as cmake
+
+
+MULTI_CONFIG_GENERATORS = ['Ninja Multi-Config', 'Xcode']
+
+def is_multi_config(generator):
+    if generator is None: return False
+    return generator in MULTI_CONFIG_GENERATORS or generator.startswith('Visual Studio')
+
+
+def get_store_key(hash, include=None, exclude=None):
+    key = util.get_hash_key(hash)
+    # A filtered extraction is a different tree than the full archive
+    if include or exclude:
+        key = key + '-' + hashlib.sha1(json.dumps([include or [], exclude or []]).encode('utf-8')).hexdigest()[:12]
+    return key
 
 
 class Builder:
@@ -8,6 +25,7 @@ class Builder:
         self.src_dir = src_dir
         self.arch_dir = arch_dir
         self.build_dir = build_dir # self.get_path('build')
+        self.source_key = None
         self.cmake_original_file = '__cget_original_cmake_file__.cmake'
 
     def get_path(self, *args):
@@ -16,8 +34,21 @@ class Builder:
     def get_build_path(self, *args):
         return self.get_path('build', *args)
 
+    def get_cache(self, *names):
+        try:
+            cache = cmake.parse_cache(self.build_dir, names)
+        except FileNotFoundError:
+            cache = {}
+        return [cache.get(name) for name in names]
+
+    def get_generator(self):
+        return self.get_cache('CMAKE_GENERATOR:INTERNAL')[0]
+
     def is_make_generator(self):
-        return os.path.exists(os.path.join(self.build_dir, 'Makefile'))
+        return 'Makefiles' in (self.get_generator() or '')
+
+    def is_ninja_generator(self):
+        return (self.get_generator() or '').startswith('Ninja')
 
     def cmake(self, options=None, use_toolchain=False, **kwargs):
         if use_toolchain: self.prefix.cmd.cmake(options=util.merge({'-DCMAKE_TOOLCHAIN_FILE': self.prefix.toolchain}, options), **kwargs)
@@ -31,30 +62,94 @@ class Builder:
         self.show_log(self.get_build_path('CMakeFiles', 'CMakeOutput.log'))
         self.show_log(self.get_build_path('CMakeFiles', 'CMakeError.log'))
 
-    def fetch(self, url, fname, hash=None, copy=False, insecure=False, pkg=None):
+    def fetch(self, url, fname, hash=None, copy=False, insecure=False, pkg=None, include=None, exclude=None):
         self.prefix.log("fetch:", url)
         if insecure: url = url.replace('https', 'http')
+        f = None
         if pkg is not None:
             f = os.path.join(self.arch_dir, pkg['archive'])
-        if not os.path.isfile(f):
-            f = util.retrieve_url(url, self.arch_dir, copy=copy, insecure=insecure, hash=hash)
-        if os.path.isfile(f):
-            click.echo("Extracting archive {0} ...".format(f))
-            temp_dir = os.path.abspath('temp')
-            util.delete_dir(temp_dir)
-            os.mkdir(temp_dir)
-            util.extract_ar(archive=f, dst=temp_dir)
-            dirs = [o for o in os.listdir(temp_dir) if os.path.isdir(os.path.join(temp_dir, o))]
-            if len(dirs) != 1:
-                raise Exception('wrong count')
-            util.delete_dir(os.path.join(self.src_dir, fname))
-            os.rename(os.path.join(temp_dir, dirs[0]), os.path.join(self.src_dir, fname))
-            util.delete_dir(temp_dir)
-            return os.path.join(self.src_dir, fname)
-        return next(util.get_dirs(self.top_dir)) # list of dirs dirs, found in top_dir
+        prefetched = None
+        if f is None or not os.path.isfile(f):
+            f = prefetched = self.prefix.prefetcher.get(url)
+        try:
+            if hash and os.path.exists(self.get_store_path(get_store_key(hash, include, exclude))):
+                src = self.get_store_src(get_store_key(hash, include, exclude))
+            elif f is None and self.can_stream(url, hash):
+                src = self.stream(url, hash, insecure=insecure, include=include, exclude=exclude)
+            else:
+                if f is None or not os.path.isfile(f):
+                    f = util.retrieve_url(url, self.arch_dir, copy=copy, insecure=insecure, hash=hash, cache=self.prefix.cache)
+                if not os.path.isfile(f): 
+                    return next(util.get_dirs(self.top_dir)) # list of dirs dirs, found in top_dir
+                src = self.extract(f, hash, include=include, exclude=exclude)
+        finally:
+            self.prefix.prefetcher.discard(prefetched)
+        # The store key identifies the exact source tree that gets built
+        self.source_key = os.path.basename(os.path.dirname(src))
+        # Builds get their own writable clone, since configure steps and patches can write into the source tree
+        dst = os.path.join(self.src_dir, fname)
+        with util.staging_dir(dst) as temp_dir:
+            util.clone_dir(src, os.path.join(temp_dir, fname))
+            util.replace_dir(os.path.join(temp_dir, fname), dst)
+        return dst
+
+    def get_store_path(self, *args):
+        return os.path.join(self.arch_dir, '.store', *args)
+
+    def get_store_src(self, key):
+        dirs = list(util.get_dirs(self.get_store_path(key)))
+        if len(dirs) != 1:
+            raise Exception('wrong count')
+        return dirs[0]
+
+    def commit_store(self, temp_dir, key):
+        store = self.get_store_path(key)
+        util.make_read_only(temp_dir)
+        try:
+            os.rename(temp_dir, store)
+        except OSError:
+            # Another cget process extracted the same archive first
+            if not os.path.exists(store): raise
+        return self.get_store_src(key)
+
+    def extract(self, f, hash=None, include=None, exclude=None):
+        key = get_store_key(hash or 'sha256:' + util.hash_file(f, 'sha256'), include, exclude)
+        if os.path.exists(self.get_store_path(key)): return self.get_store_src(key)
+        click.echo("Extracting archive {0} ...".format(f))
+        with util.staging_dir(self.get_store_path(key)) as temp_dir:
+            util.extract_ar(archive=f, dst=temp_dir, select=util.member_filter(include, exclude))
+            return self.commit_store(temp_dir, key)
+
+    def can_stream(self, url, hash=None):
+        if not self.prefix.stream_extract or url.startswith('file://'): return False
+        if not any(url.endswith(ext) for ext in util.STREAM_EXTENSIONS): return False
+        # Extracting from the cache is cheaper than downloading again
+        return not (hash and self.prefix.cache.contains(get_store_key(hash)))
+
+    def stream(self, url, hash=None, insecure=False, include=None, exclude=None):
+        t, h = (hash or 'sha256:').lower().split(':')
+        hasher = hashlib.new(t)
+        name = url.split('/')[-1]
+        archive = os.path.join(util.mkdir(self.arch_dir), name)
+        with util.staging_dir(self.get_store_path(name)) as temp_dir, util.staging_dir(archive) as tee_dir:
+            tee = os.path.join(tee_dir, name)
+            util.stream_extract(url, temp_dir, tee, hasher=hasher, insecure=insecure, select=util.member_filter(include, exclude))
+            # Nothing is committed unless the whole archive matches
+            if hash and hasher.hexdigest() != h:
+                raise util.BuildError("Hash doesn't match for {0}: {1}".format(url, hash))
+            digest = hash or 'sha256:' + hasher.hexdigest()
+            # The archive is cached whole, while the store holds the tree after any filters
+            src = self.commit_store(temp_dir, get_store_key(digest, include, exclude))
+            os.replace(tee, archive)
+            if hash: self.prefix.cache.add(get_store_key(digest), archive)
+            return src
 
     def configure(self, src_dir, defines=None, generator=None, install_prefix=None, test=True, variant=None):
         self.prefix.log("configure")
+        current = self.get_generator()
+        # cmake can't switch the generator of an existing build tree
+        if generator is not None and current is not None and generator != current: util.delete_dir(self.build_dir)
+        if generator is None: generator = current or self.prefix.get_default_generator()
         util.mkdir(self.build_dir)
         args = [
             src_dir, 
@@ -67,23 +162,49 @@ class Builder:
         if self.prefix.verbose: args.extend(['-DCMAKE_VERBOSE_MAKEFILE=On'])
         if test: args.extend(['-DBUILD_TESTING=On'])
         else: args.extend(['-DBUILD_TESTING=Off'])
-        args.extend(['-DCMAKE_BUILD_TYPE={}'.format(variant or 'Release')])
+        # Every variant shares one build tree with a multi-config generator
+        if not is_multi_config(generator): args.extend(['-DCMAKE_BUILD_TYPE={}'.format(variant or 'Release')])
         if install_prefix is not None: args.extend(['-DCMAKE_INSTALL_PREFIX=' + install_prefix])
+        # cmake --build reruns cmake by itself if the project changes later on
+        fingerprint = util.get_configure_fingerprint(args, src_dir, files=[self.prefix.toolchain])
+        if util.is_configured(self.build_dir, fingerprint):
+            self.prefix.log("configure: up to date")
+            return
+        util.set_configured(self.build_dir, None)
+        # Reuse the check results of packages configured earlier with the same toolchain
+        seed_cache = self.prefix.seed_cache
+        if seed_cache is not None:
+            toolchain_fingerprint = seed.get_toolchain_fingerprint(self.prefix.toolchain)
+            seed_file = seed_cache.get(toolchain_fingerprint)
+            if seed_file: args = ['-C', seed_file] + args
         try:
             self.cmake(args=args, cwd=self.build_dir, use_toolchain=True)
         except:
             self.show_logs()
             raise
+        util.set_configured(self.build_dir, fingerprint)
+        if seed_cache is not None:
+            seed_cache.update(toolchain_fingerprint, seed.parse_check_results(os.path.join(self.build_dir, 'CMakeCache.txt')))
 
-    def build(self, target=None, variant=None, cwd=None):
+    def build(self, target=None, variant=None, cwd=None, env=None):
         self.prefix.log("build")
         args = ['--build', self.build_dir]
         if variant is not None: args.extend(['--config', variant])
         if target is not None: args.extend(['--target', target])
-        if self.is_make_generator(): 
-            args.extend(['--', '-j', str(multiprocessing.cpu_count())])
-            if self.prefix.verbose: args.append('VERBOSE=1')
-        self.cmake(args=args, cwd=cwd)
+        # Parallelism is bounded by the jobserver shared with every other build
+        jobserver = self.prefix.jobserver
+        fifo = jobserver.supports_fifo(self.get_cache('CMAKE_MAKE_PROGRAM:FILEPATH')[0])
+        with jobserver.share() as jobs:
+            native = []
+            if self.is_make_generator():
+                if not jobserver.enabled(): native.extend(['-j', str(jobs)])
+                if self.prefix.verbose: native.append('VERBOSE=1')
+            elif self.is_ninja_generator():
+                # Ninja only joins a fifo jobserver, older versions get their share of the budget directly
+                if not fifo: native.extend(['-j', str(jobs)])
+                if self.prefix.verbose: native.append('-v')
+            if native: args.extend(['--'] + native)
+            self.cmake(args=args, cwd=cwd, env=util.merge(jobserver.get_env(fifo=fifo), env), pass_fds=jobserver.get_fds())
 
     def test(self, variant=None):
         self.prefix.log("test")
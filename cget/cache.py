@@ -0,0 +1,121 @@
+import os, json, time, threading, contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import cget.util as util
+
+SIZE_UNITS = util.SIZE_UNITS
+
+def parse_size(s):
+    if s is None: return None
+    s = str(s).strip().upper().rstrip('B').rstrip('I') or '0'
+    if s[-1] in SIZE_UNITS:
+        return int(float(s[:-1]) * (1024 ** SIZE_UNITS.index(s[-1])))
+    return int(s)
+
+
+class ArchiveCache:
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = parse_size(max_size or os.environ.get('CGET_CACHE_MAX_SIZE'))
+        self.lock = threading.Lock()
+
+    def get_path(self, *args):
+        return os.path.join(self.path, *args)
+
+    def _load(self):
+        index = {}
+        p = self.get_path('index.json')
+        if os.path.exists(p):
+            with open(p) as f: index = json.load(f)
+        index.setdefault('entries', {})
+        index.setdefault('stats', {'hits': 0, 'misses': 0, 'bytes_saved': 0})
+        index.setdefault('max_size', None)
+        return index
+
+    def _save(self, index):
+        p = self.get_path('index.json')
+        tmp = '{}.{}.tmp'.format(p, os.getpid())
+        with open(tmp, 'w') as f: json.dump(index, f, indent=4)
+        os.replace(tmp, p)
+
+    @contextlib.contextmanager
+    def _index(self):
+        # Lock against other threads as well as other cget processes sharing the cache
+        with self.lock:
+            util.mkdir(self.path)
+            with open(self.get_path('index.lock'), 'a') as lock_file:
+                if fcntl: fcntl.flock(lock_file, fcntl.LOCK_EX)
+                index = self._load()
+                yield index
+                self._save(index)
+
+    def _find_entry(self, index, key):
+        entry = index['entries'].get(key)
+        if entry is None:
+            # Adopt entries written before the cache had an index
+            d = self.get_path(key)
+            names = list(util.ls(d, os.path.isfile))
+            if not names: return None
+            entry = {'file': names[0], 'size': os.path.getsize(os.path.join(d, names[0])), 'atime': time.time()}
+            index['entries'][key] = entry
+        return entry
+
+    def contains(self, key):
+        return os.path.isdir(self.get_path(key))
+
+    def get_max_size(self, index):
+        return self.max_size or index['max_size']
+
+    def get(self, key):
+        with self._index() as index:
+            entry = self._find_entry(index, key)
+            if entry is not None and os.path.isfile(self.get_path(key, entry['file'])):
+                entry['atime'] = time.time()
+                index['stats']['hits'] += 1
+                index['stats']['bytes_saved'] += entry['size']
+                return self.get_path(key, entry['file'])
+            index['entries'].pop(key, None)
+            index['stats']['misses'] += 1
+            return None
+
+    def add(self, key, f):
+        with self._index() as index:
+            name = os.path.basename(f)
+            util.mkdir(self.get_path(key))
+            util.clone_file(f, self.get_path(key, name))
+            index['entries'][key] = {'file': name, 'size': os.path.getsize(f), 'atime': time.time()}
+            self._evict(index, keep=key)
+            return self.get_path(key, name)
+
+    def _evict(self, index, keep=None):
+        max_size = self.get_max_size(index)
+        if not max_size: return
+        entries = index['entries']
+        total = sum(e['size'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['atime']):
+            if total <= max_size: break
+            if key == keep: continue
+            total = total - entries.pop(key)['size']
+            util.delete_dir(self.get_path(key))
+
+    def set_max_size(self, size):
+        with self._index() as index:
+            index['max_size'] = parse_size(size)
+            self._evict(index)
+
+    def stats(self):
+        with self._index() as index:
+            entries = index['entries']
+            return util.merge(index['stats'], {
+                'entries': len(entries),
+                'size': sum(e['size'] for e in entries.values()),
+                'max_size': self.get_max_size(index)
+            })
+
+    def clear(self):
+        with self.lock:
+            util.delete_dir(self.path)
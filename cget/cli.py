@@ -5,6 +5,13 @@ from cget.prefix import CGetPrefix
 from cget.prefix import PackageBuild
 import cget.util as util
 from cget.config import Config
+from cget.jobserver import JobServer
+from cget.cache import ArchiveCache
+from cget.binary import BinaryCache
+from cget.seed import SeedCache
+from cget.remote import RemoteCache, CacheServer
+from cget.package1 import fname_to_pkg
+import cget.owners
 
 aliases = {
     'rm': 'remove',
@@ -53,8 +60,8 @@ def use_prefix(f):
     @functools.wraps(f)
     @use_config
     def w(cfg, obj, verbose, *args, **kwargs):
-        p = CGetPrefix(cfg, verbose or obj.get('VERBOSE'))
-        f(p, *args, **kwargs)
+        with CGetPrefix(cfg, verbose or obj.get('VERBOSE')) as p:
+            f(p, *args, **kwargs)
     return w
 
 
@@ -70,6 +77,7 @@ def get_opts(f):
     @click.option('--static', is_flag=True, help="Set toolchain to build static libraries by default")
     @click.option('--debug', is_flag=True, help="Set toolchain to build debug configuration")
     @click.option('--release', is_flag=True, help="Set toolchain to build release configuration")
+    @click.option('--launcher', required=False, help="Compiler cache to use (ccache, sccache, auto or none)")
     def w( *args, **kwargs):
         if kwargs.get('shared', False) and kwargs.get('static', False):
             click.echo("ERROR: shared and static are not supported together")
@@ -81,7 +89,7 @@ def get_opts(f):
         options = {}
         defines = {}
         for k, v in kwargs.items():
-            if k in ['toolchain', 'generator', 'cxx', 'cxxflags', 'ldflags', 'std']:
+            if k in ['toolchain', 'generator', 'cxx', 'cxxflags', 'ldflags', 'std', 'launcher']:
                 if v is not None:
                     options.update({k: v})
             elif k == 'define':
@@ -240,7 +248,8 @@ def list_command(config):
 @click.option('-D', '--define', multiple=True, help="Extra configuration variables to pass to CMake")
 @click.option('--shared', is_flag=True, help="Set toolchain to build shared libraries by default")
 @click.option('--static', is_flag=True, help="Set toolchain to build static libraries by default")
-def init1_command(prefix, toolchain, generator, cxx, cxxflags, ldflags, std, define, shared, static):
+@click.option('--launcher', default='auto', envvar='CGET_COMPILER_LAUNCHER', help="Compiler cache to use (ccache, sccache or none), by default the first one found")
+def init1_command(prefix, toolchain, generator, cxx, cxxflags, ldflags, std, define, shared, static, launcher):
     """ Initialize install directory """
     if shared and static:
         click.echo("ERROR: shared and static are not supported together")
@@ -257,7 +266,8 @@ def init1_command(prefix, toolchain, generator, cxx, cxxflags, ldflags, std, def
         cxxflags=cxxflags, 
         ldflags=ldflags, 
         std=std, 
-        defines=defines)
+        defines=defines,
+        launcher=launcher)
 
 
 @cli.command(name='install1')
@@ -272,16 +282,44 @@ def init1_command(prefix, toolchain, generator, cxx, cxxflags, ldflags, std, def
 @click.option('--debug', is_flag=True, help="Install debug version")
 @click.option('--release', is_flag=True, help="Install release version")
 @click.option('--insecure', is_flag=True, help="Don't use https urls")
+@click.option('-j', '--jobs', type=int, default=1, envvar='CGET_JOBS', help="Number of packages to build at the same time")
+@click.option('--build-jobs', type=int, default=None, envvar='CGET_BUILD_JOBS', help="Number of compile jobs shared by all builds")
+@click.option('--stream', is_flag=True, envvar='CGET_STREAM_EXTRACT', help="Extract tarballs while they are downloading")
+@click.option('--no-binary-cache', is_flag=True, envvar='CGET_NO_BINARY_CACHE', help="Always build packages instead of using previously built binaries")
+@click.option('--remote-cache', envvar='CGET_REMOTE_CACHE', help="Url of a http binary cache to pull from and push to")
+@click.option('--seed-cache', is_flag=True, envvar='CGET_SEED_CACHE', help="Share compiler check results between packages")
+@click.option('--link-mode', type=click.Choice(util.LINK_MODES), envvar='CGET_LINK_MODE', help="How unlinked packages are linked back into the prefix")
 @click.argument('pkgs', nargs=-1, type=click.STRING)
-def install1_command(prefix, pkgs, define, file, test, test_all, update, generator, cmake, debug, release, insecure):
+def install1_command(prefix, pkgs, define, file, test, test_all, update, generator, cmake, debug, release, insecure, jobs, build_jobs, stream, no_binary_cache, remote_cache, seed_cache, link_mode):
     """ Install packages """
+    if link_mode: prefix.link_mode = link_mode
+    if seed_cache: prefix.seed_cache = SeedCache(prefix.get_private_path('seed'))
+    if build_jobs: prefix.jobserver = JobServer(build_jobs)
+    if stream: prefix.stream_extract = True
+    if no_binary_cache: prefix.binary_cache = None
+    elif remote_cache: prefix.binary_cache.remote = RemoteCache(remote_cache, insecure=insecure)
+    try:
+        install_pkgs(prefix, pkgs, define, file, test, test_all, update, generator, cmake, debug, release, insecure, jobs)
+    finally:
+        prefix.prefetcher.close(wait=False)
+        if prefix.binary_cache and prefix.binary_cache.remote:
+            click.echo("Uploaded {} binaries".format(prefix.binary_cache.remote.wait()))
+
+
+def install_pkgs(prefix, pkgs, define, file, test, test_all, update, generator, cmake, debug, release, insecure, jobs):
     if debug and release:
         click.echo("ERROR: debug and release are not supported together")
         sys.exit(1)
     variant = 'Release'
     if debug: variant = 'Debug'
-    pbs = [PackageBuild(pkg, define=define, cmake=cmake, variant=variant) for pkg in pkgs]
-    for pb in util.flat([prefix.from_file(file), pbs]):
+    pbs = list(util.flat([prefix.from_file(file), [PackageBuild(pkg, define=define, cmake=cmake, variant=variant) for pkg in pkgs]]))
+    if jobs > 1:
+        with prefix.try_("Failed to build packages"):
+            for msg in prefix.install_all(pbs, test=test, test_all=test_all, update=update, generator=generator, insecure=insecure, jobs=jobs):
+                click.echo(msg)
+        return
+    prefix.prefetch_all(pbs, insecure=insecure)
+    for pb in pbs:
         with prefix.try_("Failed to build package {}".format(pb.to_name()), on_fail=lambda: prefix.remove(pb)):
             click.echo(prefix.install(pb, test=test, test_all=test_all, update=update, generator=generator, insecure=insecure))
 
@@ -296,9 +334,11 @@ def install1_command(prefix, pkgs, define, file, test, test_all, update, generat
 @click.option('-T', '--target', default=None, help="Cmake target to build")
 @click.option('-y', '--yes', is_flag=True, default=False)
 @click.option('-G', '--generator', envvar='CGET_GENERATOR', help='Set the generator for CMake to use')
+@click.option('--build-jobs', type=int, default=None, envvar='CGET_BUILD_JOBS', help="Number of compile jobs")
 @click.argument('pkg', nargs=1, default='.', type=click.STRING)
-def build1_command(prefix, pkg, define, test, configure, clean, path, yes, target, generator):
+def build1_command(prefix, pkg, define, test, configure, clean, path, yes, target, generator, build_jobs):
     """ Build package """
+    if build_jobs: prefix.jobserver = JobServer(build_jobs)
     pb = PackageBuild(pkg).merge_defines(define)
     with prefix.try_("Failed to build package {}".format(pb.to_name())):
         if configure: prefix.build_configure(pb)
@@ -330,6 +370,22 @@ def remove_command(prefix, pkgs, yes, unlink, all):
                 click.echo("{} package {}".format(verb, pkg))
 
 
+@cli.command(name='owns')
+@use_prefix
+@click.argument('paths', nargs=-1, type=click.STRING)
+def owns_command(prefix, paths):
+    """ Show the package that installed a file """
+    for path in paths:
+        f = os.path.join(prefix.prefix, path)
+        owner = prefix.owners.owner(f)
+        if owner is None:
+            click.echo("{} is not owned by any package".format(path))
+            continue
+        package, hash = owner
+        modified = hash is not None and hash != cget.owners.get_content_hash(f)
+        click.echo("{} is owned by {}{}".format(path, fname_to_pkg(package).to_name(), " (modified)" if modified else ""))
+
+
 # TODO: Make this command hidden
 @cli.command(name='size')
 @use_prefix
@@ -351,6 +407,75 @@ def clean1_command(prefix, yes, cache):
         if not yes: yes = click.confirm("Are you sure you want to delete all cget packages in {}?".format(prefix.prefix))
         if yes: prefix.clean()
 
+@cli.group(name='cache')
+def cache_group():
+    """ Manage the download and binary caches """
+
+
+@cache_group.command(name='stats')
+def cache_stats_command():
+    """ Show cache hits, misses and bytes saved """
+    stats = ArchiveCache(util.get_cache_path()).stats()
+    click.echo("Location: {}".format(util.get_cache_path()))
+    click.echo("Entries: {}".format(stats['entries']))
+    click.echo("Size: {}".format(util.format_size(stats['size'])))
+    click.echo("Max size: {}".format(util.format_size(stats['max_size']) if stats['max_size'] else 'unlimited'))
+    click.echo("Hits: {}".format(stats['hits']))
+    click.echo("Misses: {}".format(stats['misses']))
+    click.echo("Bytes saved: {}".format(util.format_size(stats['bytes_saved'])))
+    stats = BinaryCache(util.get_cache_path('binary')).stats()
+    click.echo("Binary entries: {}".format(stats['entries']))
+    click.echo("Binary size: {}".format(util.format_size(stats['size'])))
+    click.echo("Binary max size: {}".format(util.format_size(stats['max_size']) if stats['max_size'] else 'unlimited'))
+    click.echo("Binary hits: {}".format(stats['hits']))
+    click.echo("Binary misses: {}".format(stats['misses']))
+
+
+@cache_group.command(name='limit')
+@click.argument('size')
+@click.option('--binary', 'binary_size', default=None, help="Maximum size of the binary cache, when it differs from the archive cache")
+def cache_limit_command(size, binary_size):
+    """ Set the maximum cache size (ie 10G), least recently used archives and binaries are evicted first """
+    ArchiveCache(util.get_cache_path()).set_max_size(size)
+    BinaryCache(util.get_cache_path('binary')).set_max_size(binary_size or size)
+
+
+@cache_group.command(name='clean')
+def cache_clean_command():
+    """ Remove all cached archives and binaries """
+    ArchiveCache(util.get_cache_path()).clear()
+
+
+@cli.command(name='stats')
+@click.option('--launcher', default='auto', envvar='CGET_COMPILER_LAUNCHER', help="Compiler cache to show (ccache or sccache), by default every one found")
+def stats_command(launcher):
+    """ Show compiler cache statistics """
+    launchers = [util.find_launcher(launcher)] if launcher != 'auto' else [util.which(l, throws=False) for l in util.COMPILER_LAUNCHERS]
+    launchers = [l for l in launchers if l]
+    if not launchers: click.echo("No compiler cache found")
+    for l in launchers:
+        click.secho(util.get_launcher_name(l), bold=True)
+        util.cmd([l] + util.LAUNCHER_STATS_ARGS.get(util.get_launcher_name(l), ['-s']))
+
+
+@cli.command(name='serve-cache')
+@click.option('-d', '--directory', default=None, help="Directory to store binaries in")
+@click.option('--host', default='127.0.0.1', help="Address to listen on")
+@click.option('--port', type=int, default=8383, help="Port to listen on")
+@click.option('-v', '--verbose', is_flag=True, help="Log every request")
+def serve_cache_command(directory, host, port, verbose):
+    """ Serve a binary cache over http """
+    # Kept out of the client cache, so 'cget cache clean' doesn't delete what the server stores
+    server = CacheServer(directory or util.get_app_dir('serve-cache'), host=host, port=port, verbose=verbose)
+    click.echo("Serving {} at {}".format(server.root, server.get_url()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 @cli.command(name='pkg-config', context_settings=dict(
     ignore_unknown_options=True,
 ))
@@ -2,7 +2,7 @@ import re
 import os
 import shutil
 import click
-from cget.util import cmd, delete_dir
+from cget.util import cmd, delete_dir, get_configure_fingerprint, is_configured, set_configured, find_launcher
 
 
 def parse_project_name(directory):
@@ -59,8 +59,17 @@ class CMake:
                 args += ['-D' + d + '=' + dv for d, dv in v.items()]
             elif o == 'generator':
                 args += ['-G', v]
+            elif o == 'launcher':
+                launcher = find_launcher(v)
+                if launcher: args += ['-DCMAKE_C_COMPILER_LAUNCHER=' + launcher, '-DCMAKE_CXX_COMPILER_LAUNCHER=' + launcher]
         args.append(src_dir)
+        fingerprint = get_configure_fingerprint(args, src_dir)
+        if is_configured(build_dir, fingerprint):
+            click.echo('Configuration is up to date')
+            return
+        set_configured(build_dir, None)
         cmd(args, cwd=build_dir)
+        set_configured(build_dir, fingerprint)
 
     def build(self, src_dir=None, build_dir=None, options=None):
         args = [self.cmake, '--build', build_dir]
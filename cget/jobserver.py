@@ -0,0 +1,109 @@
+import os, re, shutil, tempfile, threading, contextlib, multiprocessing, subprocess
+
+# First versions that can join a jobserver through a named fifo
+FIFO_VERSIONS = [('ninja', (1, 13)), ('make', (4, 4))]
+
+__VERSIONS__ = {}
+
+def get_version(program):
+    if program not in __VERSIONS__:
+        try:
+            out = subprocess.check_output([program, '--version'], stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+            m = re.search(r'(\d+)\.(\d+)', out)
+            __VERSIONS__[program] = m and (int(m.group(1)), int(m.group(2)))
+        except (OSError, subprocess.CalledProcessError):
+            __VERSIONS__[program] = None
+    return __VERSIONS__[program]
+
+
+class JobServer:
+    def __init__(self, jobs=None):
+        self.jobs = max(1, int(jobs or os.environ.get('CGET_BUILD_JOBS') or multiprocessing.cpu_count()))
+        self.fds = None
+        self.fifo = None
+        self.running = 0
+        # cget keeps the implicit slot of the jobserver for one build at a time
+        self.implicit = True
+        self.waiting = 0
+        self.lent = 0
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return os.name == 'posix'
+
+    def get_fds(self):
+        if not self.enabled(): return ()
+        with self.lock:
+            if self.fds is None:
+                # A named fifo holds the tokens, so clients can join it by path or by file descriptor
+                d = tempfile.mkdtemp(prefix='cget-jobserver-')
+                self.fifo = os.path.join(d, 'fifo')
+                os.mkfifo(self.fifo, 0o600)
+                fd = os.open(self.fifo, os.O_RDWR)
+                os.set_inheritable(fd, True)
+                # The implicit job slot is the last one
+                os.write(fd, b'+' * (self.jobs - 1))
+                self.fds = (fd, fd)
+        return self.fds
+
+    def supports_fifo(self, program):
+        if not self.enabled() or not program: return False
+        name = os.path.basename(program).lower()
+        for tool, version in FIFO_VERSIONS:
+            if tool in name: return (get_version(program) or (0, 0)) >= version
+        return False
+
+    def get_env(self, fifo=False):
+        if not self.enabled(): return {}
+        r, w = self.get_fds()
+        auth = 'fifo:' + self.fifo if fifo else '{0},{1}'.format(r, w)
+        return { 'MAKEFLAGS': ' -j{0} --jobserver-auth={1}'.format(self.jobs, auth) }
+
+    def acquire(self):
+        # Every build child owns one implicit job slot, so only the first build runs in cget's own slot
+        # and the others take a token first, which keeps the total at the number of jobs
+        if not self.enabled(): return None
+        with self.lock:
+            if self.implicit:
+                self.implicit = False
+                return None
+            self.waiting = self.waiting + 1
+        try:
+            return os.read(self.get_fds()[0], 1)
+        finally:
+            with self.lock: self.waiting = self.waiting - 1
+
+    def release(self, token):
+        if not self.enabled(): return
+        with self.lock:
+            if token is None and self.waiting:
+                # A build blocked on the pipe can't see the implicit slot, so it is lent as a token
+                self.lent = self.lent + 1
+                token = b'+'
+            elif token is None or (self.lent and not self.waiting):
+                if token is not None: self.lent = self.lent - 1
+                self.implicit = True
+                return
+        os.write(self.get_fds()[1], token)
+
+    @contextlib.contextmanager
+    def share(self):
+        # Builds that can't join the jobserver split the budget with the other builds running at the same time
+        with self.lock:
+            self.running = self.running + 1
+            jobs = max(1, self.jobs // self.running)
+        try:
+            token = self.acquire()
+            try:
+                yield jobs
+            finally:
+                self.release(token)
+        finally:
+            with self.lock: self.running = self.running - 1
+
+    def close(self):
+        if self.fds is not None:
+            os.close(self.fds[0])
+            shutil.rmtree(os.path.dirname(self.fifo), ignore_errors=True)
+            self.fds = None
+            self.fifo = None
@@ -0,0 +1,82 @@
+import os, posixpath, sqlite3, threading, contextlib
+
+import cget.util as util
+
+
+def get_content_hash(f):
+    if not os.path.isfile(f): return None
+    return 'sha256:' + util.hash_file(f, 'sha256')
+
+
+class OwnerIndex:
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+    def relpath(self, f):
+        return os.path.relpath(os.path.join(self.prefix, f), self.prefix).replace(os.sep, '/')
+
+    @contextlib.contextmanager
+    def _db(self):
+        with self.lock:
+            util.mkdir(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=60)
+            try:
+                # Every call is a single transaction
+                with conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, package TEXT NOT NULL, hash TEXT)')
+                    conn.execute('CREATE INDEX IF NOT EXISTS files_package ON files (package)')
+                    yield conn
+            finally:
+                conn.close()
+
+    def _find(self, conn, rel):
+        # A file inside a folded directory belongs to whoever owns the directory
+        while rel:
+            row = conn.execute('SELECT package, hash FROM files WHERE path = ?', (rel,)).fetchone()
+            if row: return row
+            rel = posixpath.dirname(rel)
+        return None
+
+    def add(self, package, files):
+        rows = [(self.relpath(f), package, get_content_hash(os.path.join(self.prefix, f))) for f in files]
+        with self._db() as conn:
+            conn.executemany('INSERT OR REPLACE INTO files (path, package, hash) VALUES (?, ?, ?)', rows)
+
+    def remove(self, package):
+        with self._db() as conn:
+            conn.execute('DELETE FROM files WHERE package = ?', (package,))
+
+    def owner(self, f):
+        with self._db() as conn:
+            return self._find(conn, self.relpath(f))
+
+    def discard(self, files):
+        with self._db() as conn:
+            conn.executemany('DELETE FROM files WHERE path = ?', [(self.relpath(f),) for f in files])
+
+    def folded(self):
+        # Directories are the only entries without a content hash, besides files that have gone missing
+        with self._db() as conn:
+            rows = conn.execute('SELECT path FROM files WHERE hash IS NULL').fetchall()
+        links = (os.path.join(self.prefix, row[0]) for row in rows)
+        return [f for f in links if os.path.islink(f) and os.path.isdir(f)]
+
+    def owned(self, package, files):
+        result = []
+        with self._db() as conn:
+            for f in files:
+                row = conn.execute('SELECT package FROM files WHERE path = ?', (self.relpath(f),)).fetchone()
+                if row is None or row[0] == package: result.append(f)
+        return result
+
+    def conflicts(self, package, files):
+        result = []
+        with self._db() as conn:
+            for f in files:
+                rel = self.relpath(f)
+                row = conn.execute('SELECT package FROM files WHERE path = ?', (rel,)).fetchone()
+                if row is None and os.path.lexists(os.path.join(self.prefix, rel)): row = self._find(conn, rel) or (None,)
+                if row and row[0] != package: result.append((rel, row[0]))
+        return result
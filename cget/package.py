@@ -74,33 +74,24 @@ class Package:
         else:
             try:
                 click.echo('Fetching file {0} ...'.format(self.url))
-                urlretrieve(self.url, fn)
+                with util.staging_dir(fn) as temp_dir:
+                    urlretrieve(self.url, os.path.join(temp_dir, self.archive))
+                    os.replace(os.path.join(temp_dir, self.archive), fn)
                 click.echo('Ok.')
             except ConnectionError as e:
                 click.echo(str(e))
                 sys.exit(2)
-        temp_dir = os.path.abspath('temp')
 
-        re_extract = False
-        exists = os.path.isdir(temp_dir)
-        if not exists or re_extract:
+        with util.staging_dir(os.path.join(self.config.src_root(), self.archive)) as temp_dir:
             click.echo("Extracting archive {0} ...".format(fn))
-            if exists:
-                util.delete_dir(temp_dir)
-            os.mkdir(temp_dir)
             util.extract_ar(archive=fn, dst=temp_dir)
-        else:
-            click.echo("Extracting skipped: using temporary")
-
-        dirs = [o for o in os.listdir(temp_dir) if os.path.isdir(os.path.join(temp_dir, o))]
-        if len(dirs) != 1:
-            raise Exception('Wrong dir count')
-        temp_src_dir = os.path.join(temp_dir, dirs[0])
-        self.choose_builder(temp_src_dir)
-        src_dir = self.src_dir()
-        util.delete_dir(src_dir)
-        os.rename(temp_src_dir, src_dir)
-        util.delete_dir(temp_dir)
+            dirs = [o for o in os.listdir(temp_dir) if os.path.isdir(os.path.join(temp_dir, o))]
+            if len(dirs) != 1:
+                raise Exception('Wrong dir count')
+            temp_src_dir = os.path.join(temp_dir, dirs[0])
+            self.choose_builder(temp_src_dir)
+            src_dir = self.src_dir()
+            util.replace_dir(temp_src_dir, src_dir)
         self.stage = FETCHED
         self.save()
         click.echo("Sources placed to {0}".format(src_dir))
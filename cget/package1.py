@@ -41,7 +41,7 @@ def fname_to_pkg(fname):
 
 
 class PackageBuild:
-    def __init__(self, pkg_src=None, define=None, parent=None, test=False, hash=None, build=None, cmake=None, variant=None, requirements=None):
+    def __init__(self, pkg_src=None, define=None, parent=None, test=False, hash=None, build=None, cmake=None, variant=None, requirements=None, include=None, exclude=None, header_only=False):
         self.pkg_src = pkg_src
         self.define = define or []
         self.parent = parent
@@ -51,6 +51,9 @@ class PackageBuild:
         self.cmake = cmake
         self.variant = variant or 'Release'
         self.requirements = requirements
+        self.include = include or []
+        self.exclude = exclude or []
+        self.header_only = header_only
 
     def merge_defines(self, defines):
         result = copy.copy(self)
@@ -89,7 +92,10 @@ def parse_pkg_build_tokens(args):
     parser.add_argument('-D', '--define', action='append', default=[])
     parser.add_argument('-H', '--hash')
     parser.add_argument('-X', '--cmake')
+    parser.add_argument('-I', '--include', action='append', default=[])
+    parser.add_argument('-E', '--exclude', action='append', default=[])
     parser.add_argument('-t', '--test', action='store_true')
     parser.add_argument('-b', '--build', action='store_true')
+    parser.add_argument('--header-only', action='store_true')
     return parser.parse_args(args=args, namespace=PackageBuild())
 
@@ -0,0 +1,53 @@
+import os, threading
+from concurrent import futures
+
+import cget.util as util
+
+
+class Prefetcher:
+    def __init__(self, arch_dir, jobs=None, cache=None):
+        self.arch_dir = arch_dir
+        self.cache = cache
+        self.jobs = max(1, int(jobs or os.environ.get('CGET_FETCH_JOBS') or 4))
+        self.executor = None
+        self.downloads = {}
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        if self.executor is None: self.executor = futures.ThreadPoolExecutor(max_workers=self.jobs)
+        return self.executor
+
+    def prefetch(self, url, fname, hash=None, insecure=False):
+        if url is None or '://' not in url or url.startswith('file://'): return None
+        if insecure: url = url.replace('https', 'http')
+        with self.lock:
+            if url not in self.downloads:
+                # Each package gets its own directory since archive names often clash (ie master.tar.gz)
+                dst = util.mkdir(self.get_path(fname))
+                self.downloads[url] = self._get_executor().submit(util.retrieve_url, url, dst, insecure=insecure, hash=hash, progress=False, cache=self.cache)
+            return self.downloads[url]
+
+    def get_path(self, *args):
+        return os.path.join(self.arch_dir, 'prefetch', *args)
+
+    def get(self, url):
+        with self.lock:
+            future = self.downloads.pop(url, None)
+        if future is None: return None
+        # A failed prefetch is just a miss, the download is retried when the package is fetched
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def discard(self, f):
+        # Once fetched, the archive is in the cache or the source store
+        if f and f.startswith(self.get_path() + os.sep): util.delete_dir(os.path.dirname(f))
+
+    def close(self, wait=True):
+        if not wait:
+            # Downloads that haven't started are dropped, so a failed install exits right away
+            with self.lock:
+                for future in self.downloads.values(): future.cancel()
+        if self.executor is not None: self.executor.shutdown(wait=wait)
+        self.executor = None
@@ -1,10 +1,17 @@
-import os, shutil, shlex, six, inspect, click, contextlib, uuid, sys, functools
+import os, shutil, shlex, six, inspect, click, contextlib, uuid, sys, functools, threading
 
 from cget.builder import Builder
 from cget.package1 import fname_to_pkg
 from cget.package1 import PackageSource
 from cget.package1 import PackageBuild
 from cget.package1 import parse_pkg_build_tokens
+from cget.scheduler import Scheduler
+from cget.jobserver import JobServer
+from cget.prefetch import Prefetcher
+from cget.cache import ArchiveCache
+from cget.binary import BinaryCache
+import cget.binary as binary
+from cget.owners import OwnerIndex
 import cget.util as util
 from cget.types import returns
 from cget.types import params
@@ -93,6 +100,27 @@ class CGetPrefix:
         self.cmd = util.Commander(paths=[self.get_path('bin')], env=self.get_env(), verbose=self.verbose)
         self.toolchain = self.write_cmake()
         self.generator = None
+        self.jobserver = JobServer()
+        self.stream_extract = bool(os.environ.get('CGET_STREAM_EXTRACT'))
+        self.cache = ArchiveCache(util.get_cache_path())
+        self.prefetcher = Prefetcher(os.path.abspath('src-arch'), cache=self.cache)
+        self.binary_cache = BinaryCache(util.get_cache_path('binary'))
+        self.seed_cache = None
+        self.owners = OwnerIndex(self.get_private_path('owners.db'), self.prefix)
+        self.fold_lock = threading.Lock()
+        self.link_mode = os.environ.get('CGET_LINK_MODE') or util.get_default_link_mode()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # Downloads that haven't started are dropped, but uploads to the remote cache are finished
+        self.prefetcher.close(wait=False)
+        if self.binary_cache and self.binary_cache.remote: self.binary_cache.remote.close()
+        self.jobserver.close()
 
     def log(self, *args):
         if self.verbose: click.secho(' '.join([str(arg) for arg in args]), bold=True)
@@ -102,17 +130,36 @@ class CGetPrefix:
             raise util.BuildError('ASSERTION FAILURE: ', ' '.join([str(arg) for arg in args]))
 
 
+    def get_root(self):
+        return os.path.dirname(self.prefix)
+
     def get_env(self):
         return {
-            'PKG_CONFIG_PATH': self.pkg_config_path()
+            'PKG_CONFIG_PATH': self.pkg_config_path(),
+            # Let compiler caches hit across the different build-<config> directories
+            'CCACHE_BASEDIR': os.environ.get('CCACHE_BASEDIR', self.get_root()),
+            'SCCACHE_BASEDIRS': os.environ.get('SCCACHE_BASEDIRS', self.get_root())
         }
 
     def write_cmake(self, always_write=False, **kwargs):
+        for lang in ['C', 'CXX']:
+            util.mkfile(self.get_private_path(), self.get_flags_override_name(lang), self.generate_cmake_flags_override(lang), always_write=always_write)
         return util.mkfile(self.get_private_path(), 'cget.cmake', self.generate_cmake_toolchain(**kwargs), always_write=always_write)
 
+    def get_flags_override_name(self, lang):
+        return 'cget-{}-flags.cmake'.format(lang.lower())
+
+    @returns(inspect.isgenerator)
+    @util.yield_from
+    def generate_cmake_flags_override(self, lang):
+        # cmake includes this once the compiler is known and before CMAKE_<LANG>_FLAGS_INIT is used
+        yield cmake_if('CMAKE_{}_COMPILER_ID MATCHES "GNU|Clang"'.format(lang),
+            ['string(APPEND CMAKE_{}_FLAGS_INIT {})'.format(lang, util.quote(' -fdebug-prefix-map={}=.'.format(self.get_root())))]
+        )
+
     @returns(inspect.isgenerator)
     @util.yield_from
-    def generate_cmake_toolchain(self, toolchain=None, generator=None, cxx=None, cxxflags=None, ldflags=None, std=None, defines=None):
+    def generate_cmake_toolchain(self, toolchain=None, generator=None, cxx=None, cxxflags=None, ldflags=None, std=None, defines=None, launcher='auto'):
         set_ = cmake_set
         if_ = cmake_if
         append_ = cmake_append
@@ -121,6 +168,17 @@ class CGetPrefix:
         yield ['include_directories(SYSTEM ${CMAKE_PREFIX_PATH}/include)']
         if generator: yield set_('CMAKE_GENERATOR', generator)
         if toolchain: yield ['include({})'.format(util.quote(os.path.abspath(toolchain)))]
+        launcher = util.find_launcher(launcher)
+        if launcher:
+            for lang in ['C', 'CXX']:
+                yield set_('CMAKE_{}_COMPILER_LAUNCHER'.format(lang), launcher, cache='STRING')
+            # Keep the build directory out of the debug info so it doesn't defeat the cache.
+            # The compiler isn't known yet here, so the flags are added from a rules override.
+            for lang in ['C', 'CXX']:
+                override = 'CMAKE_USER_MAKE_RULES_OVERRIDE_{}'.format(lang)
+                yield if_('NOT {}'.format(override),
+                    set_(override, self.get_private_path(self.get_flags_override_name(lang)))
+                )
         yield if_('CMAKE_CROSSCOMPILING',
             append_('CMAKE_FIND_ROOT_PATH', self.prefix)
         )
@@ -149,6 +207,11 @@ class CGetPrefix:
         set_('CMAKE_FIND_FRAMEWORK', 'LAST', cache='STRING')
 
 
+    def get_default_generator(self):
+        if self.generator: return self.generator
+        if util.which('ninja', throws=False): return 'Ninja'
+        return None
+
     def get_path(self, *paths):
         return os.path.join(self.prefix, *paths)
 
@@ -181,6 +244,58 @@ class CGetPrefix:
     def get_unlink_directory(self, *dirs):
         return self.get_private_path('unlink', *dirs)
 
+    def get_manifest(self, pkg_dir):
+        f = os.path.join(pkg_dir, 'manifest.txt')
+        if not os.path.isfile(f): return None
+        with open(f) as fp:
+            return [self.get_path(line.strip()) for line in fp if line.strip()]
+
+    def save_manifest(self, name, files):
+        pkg_dir = util.mkdir(self.get_package_directory(name))
+        # Paths are stored relative to the prefix so they survive the prefix being moved
+        files = [os.path.relpath(file, self.prefix) for file in files]
+        files = [file for file in files if not file.startswith(os.pardir)]
+        with open(os.path.join(pkg_dir, 'manifest.txt'), 'w') as f:
+            for file in files: f.write(file + '\n')
+        return files
+
+    def write_manifest(self, name, files):
+        self.owners.add(name, self.save_manifest(name, files))
+
+    def unfold(self, link):
+        row = self.owners.owner(link)
+        files = util.unfold_link(link)
+        if row is None: return files
+        # The package that owned the folded directory now owns the links inside it instead
+        manifest = self.get_manifest(self.get_package_directory(row[0])) or []
+        self.save_manifest(row[0], [f for f in manifest if os.path.normpath(f) != os.path.normpath(link)] + files)
+        self.owners.discard([link])
+        self.owners.add(row[0], files)
+        return files
+
+    def unfold_all(self, files=None):
+        # Installing straight into the prefix mustn't write through a folded directory into another package
+        with self.fold_lock:
+            while True:
+                links = [link for link in self.owners.folded() if files is None or any(f.startswith(link + os.sep) for f in files)]
+                if not links: return
+                for link in links: self.unfold(link)
+
+    def write_install_manifest(self, builder, pb):
+        files = binary.read_manifest(os.path.join(builder.build_dir, 'install_manifest.txt'))
+        if files is None: return
+        # cmake has already overwritten them, so all that can be done is to say so
+        for path, owner in self.owners.conflicts(pb.to_fname(), files):
+            if owner: click.echo("WARNING: {} from package {} was overwritten by {}".format(path, owner, pb.to_name()))
+        self.write_manifest(pb.to_fname(), files)
+
+    def check_conflicts(self, name, files):
+        conflicts = self.owners.conflicts(name, files)
+        if conflicts:
+            raise util.BuildError("Package {} conflicts with files already in the prefix:\n".format(name) + '\n'.join(
+                '    {} (owned by {})'.format(path, owner or 'no package') for path, owner in conflicts
+            ))
+
     def get_deps_directory(self, name, *dirs):
         return self.get_package_directory(name, 'deps', *dirs)
 
@@ -263,22 +378,35 @@ class CGetPrefix:
     def write_parent(self, pb, track=True):
         if track and pb.parent is not None: util.mkfile(self.get_deps_directory(pb.to_fname()), pb.parent, pb.parent)
 
-    def install_deps(self, pb, d, test=False, test_all=False, generator=None, insecure=False):
+    def get_deps(self, pb, d, test=False, test_all=False):
         for dependent in self.from_file(pb.requirements or os.path.join(d, 'requirements.txt'), pb.pkg_src.url):
             transient = dependent.test or dependent.build
             testing = test or test_all
             installable = not dependent.test or dependent.test == testing
-            if installable: 
-                self.install(dependent.of(pb), test_all=test_all, generator=generator, track=not transient, insecure=insecure)
+            if installable: yield dependent.of(pb), transient
 
-    @returns(six.string_types)
-    @params(pb=PACKAGE_SOURCE_TYPES, test=bool, test_all=bool, update=bool, track=bool)
-    def install(self, pb, test=False, test_all=False, generator=None, update=False, track=True, insecure=False):
+    def prefetch(self, pb, insecure=False):
+        # Streamed archives are downloaded as they are extracted instead
+        if self.stream_extract: return
         pb = self.parse_pkg_build(pb)
-        pkg = self.config['packages'].get(pb.pkg_src.name, None)
+        if pb.pkg_src.name in self.config['packages']: return
+        for d in [self.get_package_directory(pb.to_fname()), self.get_unlink_directory(pb.to_fname())]:
+            if os.path.exists(d): return
+        self.prefetcher.prefetch(pb.pkg_src.url, pb.to_fname(), hash=pb.hash, insecure=insecure)
+
+    def prefetch_all(self, pbs, insecure=False):
+        for pb in pbs: self.prefetch(pb, insecure=insecure)
+
+    def install_deps(self, pb, d, test=False, test_all=False, generator=None, insecure=False):
+        deps = list(self.get_deps(pb, d, test=test, test_all=test_all))
+        # Start downloading the siblings while the first dependency builds
+        self.prefetch_all((dependent for dependent, transient in deps), insecure=insecure)
+        for dependent, transient in deps:
+            self.install(dependent, test_all=test_all, generator=generator, track=not transient, insecure=insecure)
+
+    def _check_installed(self, pb, update=False, track=True):
         pkg_dir = self.get_package_directory(pb.to_fname())
         unlink_dir = self.get_unlink_directory(pb.to_fname())
-        install_dir = self.prefix # self.get_package_directory(pb.to_fname(), 'install')
         # If its been unlinked, then link it in
         if os.path.exists(unlink_dir):
             if update: shutil.rmtree(unlink_dir)
@@ -290,32 +418,169 @@ class CGetPrefix:
             self.write_parent(pb, track=track)
             if update: self.remove(pb)
             else: return "Package {} already installed".format(pb.to_name())
+        return None
+
+    def _create_pkg_builder(self, pb):
         arch_dir = os.path.abspath('src-arch')
         src_dir = os.path.abspath('src')
         build_dir = os.path.join(self.build_path_var, pb.to_fname())
-        with self.create_builder(arch_dir, src_dir, build_dir) as builder:
+        return self.create_builder(arch_dir, src_dir, build_dir)
+
+    def _fetch_pkg(self, builder, pb, insecure=False):
+        pkg = self.config['packages'].get(pb.pkg_src.name, None)
+        return builder.fetch(pb.pkg_src.url, pb.pkg_src.fname, pb.hash, (pb.cmake != None), insecure=insecure, pkg=pkg, include=pb.include, exclude=pb.exclude)
+
+    def get_binary_key(self, pb, src_dir, source_key):
+        if self.binary_cache is None or source_key is None: return None
+        return binary.get_fingerprint(source_key, pb, self.toolchain, pb.requirements or os.path.join(src_dir, 'requirements.txt'))
+
+    def restore_binary(self, builder, pb, key):
+        files = self.binary_cache.restore(key, self.prefix, self.unfold_all)
+        if files is None: return False
+        self.log("restored from binary cache:", pb.to_name(), key)
+        util.mkdir(builder.build_dir)
+        util.write_to(os.path.join(builder.build_dir, 'install_manifest.txt'), files)
+        return True
+
+    def save_binary(self, builder, pb, key):
+        files = binary.read_manifest(os.path.join(builder.build_dir, 'install_manifest.txt'))
+        if files: self.binary_cache.save(key, files, self.prefix)
+
+    def is_header_only(self, pb):
+        if pb.header_only: return True
+        return pb.cmake is not None and os.path.normcase(os.path.abspath(pb.cmake)) == os.path.normcase(util.cget_dir('cmake', 'header.cmake'))
+
+    def get_header_files(self, pb, src_dir):
+        # Same layout as cmake/header.cmake
+        defines = dict((k.split(':')[0], v) for k, v in util.to_define_dict(pb.define).items())
+        include_dir = os.path.join(src_dir, defines.get('INCLUDE_DIR', 'include'))
+        header_dir = os.path.join(src_dir, defines.get('HEADER_DIR', include_dir))
+        dst = self.get_path('include')
+        if os.path.isdir(include_dir): root = include_dir
+        elif 'HEADER_DIR' in defines and os.path.isdir(header_dir):
+            root = header_dir
+            dst = os.path.join(dst, os.path.basename(os.path.normpath(header_dir)))
+        else:
+            headers = util.ls(src_dir, lambda p: util.is_header(os.path.basename(p)) and os.path.isfile(p))
+            return dict((os.path.join(dst, f), os.path.join(src_dir, f)) for f in headers)
+        files = {}
+        for r, dirs, names in os.walk(root):
+            for name in filter(util.is_header, names):
+                files[os.path.join(dst, os.path.relpath(os.path.join(r, name), root))] = os.path.join(r, name)
+        return files
+
+    def install_headers(self, builder, pb, src_dir):
+        self.log("install headers:", pb.to_name())
+        files = self.get_header_files(pb, src_dir)
+        self.unfold_all(files)
+        files = util.copy_files(files)
+        util.mkdir(builder.build_dir)
+        util.write_to(os.path.join(builder.build_dir, 'install_manifest.txt'), files)
+
+    def install_build(self, builder, pb):
+        # What cmake will install isn't known up front, so when a folded directory could be in the way
+        # the install is staged first and only the directories it goes through are unfolded
+        if not self.owners.folded(): return builder.build(target='install', variant=pb.variant)
+        stage = os.path.join(builder.build_dir, 'stage')
+        util.delete_dir(stage)
+        builder.build(target='install', variant=pb.variant, env={'DESTDIR': stage})
+        manifest = os.path.join(builder.build_dir, 'install_manifest.txt')
+        # Depending on the cmake version, the manifest has the paths with or without DESTDIR
+        files = [f[len(stage):] if f.startswith(stage + os.sep) else f for f in binary.read_manifest(manifest) or []]
+        self.unfold_all(files)
+        for f in files:
+            if not os.path.lexists(stage + f): continue
+            util.mkdir(os.path.dirname(f))
+            shutil.move(stage + f, f)
+        util.write_to(manifest, files)
+        util.delete_dir(stage)
+
+    def _build_pkg(self, builder, pb, src_dir, test=False, test_all=False, generator=None, source_key=None):
+        # Header only packages are just copied, without running cmake at all
+        if self.is_header_only(pb): return self.install_headers(builder, pb, src_dir)
+        # Tests need a real build to run against, and a tree configured for tests isn't cached for later installs
+        key = None if test or test_all else self.get_binary_key(pb, src_dir, source_key)
+        if key and self.restore_binary(builder, pb, key): return
+        install_dir = self.prefix # self.get_package_directory(pb.to_fname(), 'install')
+        # Setup cmake file
+        if pb.cmake: 
+            target = os.path.join(src_dir, 'CMakeLists.txt')
+            if os.path.exists(target):
+                os.rename(target, os.path.join(src_dir, builder.cmake_original_file))
+            shutil.copyfile(pb.cmake, target)
+        # Configure and build
+        builder.configure(src_dir, defines=pb.define, generator=generator, install_prefix=install_dir, test=test, variant=pb.variant)
+        builder.build(variant=pb.variant)
+        # Run tests if enabled
+        if test or test_all: builder.test(variant=pb.variant)
+        # Install
+        self.install_build(builder, pb)
+        if key: self.save_binary(builder, pb, key)
+        #if util.USE_SYMLINKS: util.symlink_dir(install_dir, self.prefix)
+        #else: util.copy_dir(install_dir, self.prefix)
+
+    @returns(six.string_types)
+    @params(pb=PACKAGE_SOURCE_TYPES, test=bool, test_all=bool, update=bool, track=bool)
+    def install(self, pb, test=False, test_all=False, generator=None, update=False, track=True, insecure=False):
+        pb = self.parse_pkg_build(pb)
+        installed = self._check_installed(pb, update=update, track=track)
+        if installed: return installed
+        with self._create_pkg_builder(pb) as builder:
             # Fetch package
-            src_dir = builder.fetch(pb.pkg_src.url, pb.pkg_src.fname, pb.hash, (pb.cmake != None), insecure=insecure, pkg=pkg)
+            src_dir = self._fetch_pkg(builder, pb, insecure=insecure)
             # Install any dependencies first
             self.install_deps(pb, src_dir, test=test, test_all=test_all, generator=generator, insecure=insecure)
-            # Setup cmake file
-            if pb.cmake: 
-                target = os.path.join(src_dir, 'CMakeLists.txt')
-                if os.path.exists(target):
-                    os.rename(target, os.path.join(src_dir, builder.cmake_original_file))
-                shutil.copyfile(pb.cmake, target)
-            # Configure and build
-            builder.configure(src_dir, defines=pb.define, generator=generator, install_prefix=install_dir, test=test, variant=pb.variant)
-            builder.build(variant=pb.variant)
-            # Run tests if enabled
-            if test or test_all: builder.test(variant=pb.variant)
-            # Install
-            builder.build(target='install', variant=pb.variant)
-            #if util.USE_SYMLINKS: util.symlink_dir(install_dir, self.prefix)
-            #else: util.copy_dir(install_dir, self.prefix)
+            self._build_pkg(builder, pb, src_dir, test=test, test_all=test_all, generator=generator, source_key=builder.source_key)
+            self.write_install_manifest(builder, pb)
         self.write_parent(pb, track=track)
         return "Successfully installed {}".format(pb.to_name())
 
+    def _schedule(self, scheduler, parents, pb, test=False, test_all=False, generator=None, update=False, track=True, insecure=False):
+        pb = self.parse_pkg_build(pb)
+        key = pb.to_fname()
+        # Already resolved, so just record the extra parent
+        if key in parents:
+            parents[key].append((pb, track))
+            return key
+        parents[key] = [(pb, track)]
+        def write_parents():
+            for parent, tracked in parents[key]:
+                self.write_parent(parent, track=tracked)
+        installed = self._check_installed(pb, update=update, track=track)
+        if installed:
+            def linked():
+                write_parents()
+                return installed
+            scheduler.add(key, linked)
+            return key
+        with self._create_pkg_builder(pb) as builder:
+            src_dir = self._fetch_pkg(builder, pb, insecure=insecure)
+            source_key = builder.source_key
+        deps = list(self.get_deps(pb, src_dir, test=test, test_all=test_all))
+        self.prefetch_all((dependent for dependent, transient in deps), insecure=insecure)
+        deps = [
+            self._schedule(scheduler, parents, dependent, test_all=test_all, generator=generator, track=not transient, insecure=insecure)
+            for dependent, transient in deps
+        ]
+        def build():
+            with self._create_pkg_builder(pb) as builder:
+                self._build_pkg(builder, pb, src_dir, test=test, test_all=test_all, generator=generator, source_key=source_key)
+                self.write_install_manifest(builder, pb)
+            write_parents()
+            return "Successfully installed {}".format(pb.to_name())
+        scheduler.add(key, build, deps, on_fail=lambda: self.remove(pb))
+        return key
+
+    def install_all(self, pbs, test=False, test_all=False, generator=None, update=False, insecure=False, jobs=1):
+        scheduler = Scheduler(jobs)
+        parents = {}
+        pbs = list(pbs)
+        self.prefetch_all(pbs, insecure=insecure)
+        # Resolve the whole requirement graph before building anything
+        for pb in pbs:
+            self._schedule(scheduler, parents, pb, test=test, test_all=test_all, generator=generator, update=update, insecure=insecure)
+        return scheduler.run()
+
     @params(pb=PACKAGE_SOURCE_TYPES, test=bool)
     def build(self, pb, test=False, target=None, generator=None):
         if generator is None: generator = self.generator
@@ -361,25 +626,55 @@ class CGetPrefix:
         unlink_dir = self.get_unlink_directory(pkg.to_fname())
         self.log("Unlink:", pkg_dir)
         if os.path.exists(pkg_dir):
-            if util.USE_SYMLINKS:
-                util.rm_symlink_from(os.path.join(pkg_dir, 'install'), self.prefix)
+            files = self.get_manifest(pkg_dir)
+            if files is not None:
+                # Files that another package has installed over since belong to that package now
+                self.unlink_files(pkg_dir, self.owners.owned(pkg.to_fname(), files), delete=delete)
             else:
-                util.rm_dup_dir(os.path.join(pkg_dir, 'install'), self.prefix, remove_both=False)
-            util.rm_empty_dirs(self.prefix)
+                if util.USE_SYMLINKS:
+                    util.rm_symlink_from(os.path.join(pkg_dir, 'install'), self.prefix)
+                else:
+                    util.rm_dup_dir(os.path.join(pkg_dir, 'install'), self.prefix, remove_both=False)
+                util.rm_empty_dirs(self.prefix)
+            self.owners.remove(pkg.to_fname())
             if delete: shutil.rmtree(pkg_dir)
             else:
                 util.mkdir(self.get_unlink_directory())
                 os.rename(pkg_dir, unlink_dir)
 
+    def unlink_files(self, pkg_dir, files, delete=False):
+        install_dir = os.path.join(pkg_dir, 'install')
+        for f in files:
+            if not os.path.lexists(f): continue
+            linked = os.path.join(install_dir, os.path.relpath(f, self.prefix))
+            if os.path.lexists(linked):
+                # Leave it if another package has replaced the link since
+                if self.is_linked(f, linked): os.remove(f)
+            elif delete: os.remove(f)
+            else:
+                # Installed straight into the prefix, so keep it with the package to link again later
+                util.mkdir(os.path.dirname(linked))
+                os.rename(f, linked)
+        util.rm_empty_parents(files, self.prefix)
+
+    def is_linked(self, f, linked):
+        # Hardlinks and copies have no target, and links inside the package are copied as relative links
+        if not os.path.islink(f): return True
+        target = os.readlink(f)
+        return target == linked or not os.path.isabs(target)
+
     @params(pkg=PACKAGE_SOURCE_TYPES)
     def link(self, pkg):
         pkg = self.parse_pkg_src(pkg)
         pkg_dir = self.get_package_directory(pkg.to_fname())
         unlink_dir = self.get_unlink_directory(pkg.to_fname())
         if os.path.exists(unlink_dir):
+            self.check_conflicts(pkg.to_fname(), list(util.get_link_files(os.path.join(unlink_dir, 'install'))))
             os.rename(unlink_dir, pkg_dir)
-            if util.USE_SYMLINKS: util.symlink_dir(os.path.join(pkg_dir, 'install'), self.prefix)
-            else: util.copy_dir(os.path.join(pkg_dir, 'install'), self.prefix)
+            if self.link_mode == 'symlink':
+                with self.fold_lock: files = util.fold_dir(os.path.join(pkg_dir, 'install'), self.prefix, self.unfold)
+            else: files = util.link_tree(os.path.join(pkg_dir, 'install'), self.prefix, self.link_mode)
+            self.write_manifest(pkg.to_fname(), files)
         # Relink dependencies
         for dep in util.ls(self.get_unlink_directory(), os.path.isdir):
             ls = util.ls(self.get_unlink_deps_directory(dep), os.path.isfile)
@@ -413,8 +708,7 @@ class CGetPrefix:
             util.delete_dir(self.get_private_path())
 
     def clean_cache(self):
-        p = util.get_cache_path()
-        if os.path.exists(p): shutil.rmtree(util.get_cache_path())
+        self.cache.clear()
 
     def pkg_config_path(self):
         libs = []
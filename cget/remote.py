@@ -0,0 +1,133 @@
+import os, re, click, hashlib, contextlib, threading
+from concurrent import futures
+from six.moves import BaseHTTPServer, socketserver, http_client
+
+import cget.util as util
+
+CHECKSUM_HEADER = 'X-Checksum-Sha256'
+# Keys can't be . or .., or start with a dot at all
+KEY_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+class RemoteCache:
+    def __init__(self, url, jobs=None, insecure=False):
+        self.url = url.rstrip('/')
+        self.insecure = insecure
+        self.jobs = max(1, int(jobs or os.environ.get('CGET_UPLOAD_JOBS') or 2))
+        self.executor = None
+        self.uploads = []
+        self.lock = threading.Lock()
+
+    def get_url(self, key):
+        return '{0}/{1}.tar.gz'.format(self.url, key)
+
+    def download(self, key, dst):
+        url = self.get_url(key)
+        f = os.path.join(dst, key + '.tar.gz')
+        h = hashlib.sha256()
+        try:
+            response = util.open_url(url, insecure=self.insecure)
+            with contextlib.closing(response), open(f, 'wb') as fp:
+                util.copy_stream(response, fp, hasher=h)
+        except (util.BuildError, http_client.HTTPException, IOError, OSError):
+            # A missing entry or an unreachable cache just means building from source
+            if os.path.exists(f): os.remove(f)
+            return None
+        checksum = response.headers.get(CHECKSUM_HEADER)
+        if checksum and checksum != h.hexdigest():
+            click.echo("WARNING: Ignoring corrupt binary from {0}".format(url))
+            os.remove(f)
+            return None
+        return f
+
+    def upload(self, key, f):
+        headers = {CHECKSUM_HEADER: util.hash_file(f, 'sha256'), 'Content-Type': 'application/gzip'}
+        try:
+            util.upload_file(self.get_url(key), f, headers=headers, insecure=self.insecure)
+            return True
+        except (util.BuildError, http_client.HTTPException, IOError, OSError) as e:
+            click.echo("WARNING: Failed to upload binary {0}: {1}".format(key, e))
+            return False
+
+    def upload_async(self, key, f):
+        with self.lock:
+            if self.executor is None: self.executor = futures.ThreadPoolExecutor(max_workers=self.jobs)
+            future = self.executor.submit(self.upload, key, f)
+            self.uploads.append(future)
+            return future
+
+    def wait(self):
+        with self.lock:
+            uploads, self.uploads = self.uploads, []
+        return sum(1 for future in uploads if future.result())
+
+    def close(self):
+        self.wait()
+        if self.executor is not None: self.executor.shutdown()
+        self.executor = None
+        util.get_http_pool().close()
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose: BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def get_file(self):
+        name = self.path.split('?')[0].strip('/')
+        if not KEY_PATTERN.match(name): return None
+        return os.path.join(self.server.root, name)
+
+    def send_empty(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_file(self, body=True):
+        f = self.get_file()
+        if f is None or not os.path.isfile(f): return self.send_empty(404)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(f)))
+        if os.path.isfile(f + '.sha256'):
+            with open(f + '.sha256') as fp: self.send_header(CHECKSUM_HEADER, fp.read().strip())
+        self.end_headers()
+        if body:
+            with open(f, 'rb') as fp: util.copy_stream(fp, self.wfile)
+
+    def do_HEAD(self):
+        self.send_file(body=False)
+
+    def do_GET(self):
+        self.send_file()
+
+    def do_PUT(self):
+        f = self.get_file()
+        length = self.headers.get('Content-Length')
+        if f is None or length is None: return self.send_empty(400)
+        h = hashlib.sha256()
+        with util.staging_dir(f) as temp_dir:
+            tmp = os.path.join(temp_dir, os.path.basename(f))
+            with open(tmp, 'wb') as fp:
+                util.copy_stream(util.LimitedReader(self.rfile, int(length)), fp, hasher=h)
+            checksum = self.headers.get(CHECKSUM_HEADER)
+            if checksum and checksum != h.hexdigest(): return self.send_empty(400)
+            util.write_to(tmp + '.sha256', [h.hexdigest()])
+            # Readers only ever see a complete upload
+            os.replace(tmp + '.sha256', f + '.sha256')
+            os.replace(tmp, f)
+        self.send_empty(201)
+
+
+class CacheServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, host='127.0.0.1', port=0, verbose=False):
+        self.root = util.mkdir(os.path.abspath(root))
+        self.verbose = verbose
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), CacheRequestHandler)
+
+    def get_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
@@ -0,0 +1,56 @@
+from concurrent import futures
+
+import cget.util as util
+
+
+class Scheduler:
+    def __init__(self, jobs=1):
+        self.jobs = max(1, int(jobs or 1))
+        self.tasks = {}
+        self.deps = {}
+        self.cleanups = {}
+        self.order = []
+
+    def __contains__(self, key):
+        return key in self.tasks
+
+    def add(self, key, f, deps=None, on_fail=None):
+        if key in self.tasks: return False
+        self.tasks[key] = f
+        self.deps[key] = list(deps or [])
+        if on_fail: self.cleanups[key] = on_fail
+        self.order.append(key)
+        return True
+
+    def _ready(self, key, done):
+        return all(dep in done or dep not in self.tasks for dep in self.deps[key])
+
+    def run(self):
+        done = set()
+        results = {}
+        pending = list(self.order)
+        running = {}
+        error = None
+        with futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                if error is None:
+                    for key in [k for k in pending if self._ready(k, done)]:
+                        if len(running) >= self.jobs: break
+                        pending.remove(key)
+                        running[executor.submit(self.tasks[key])] = key
+                if not running:
+                    if error is None and pending:
+                        error = util.BuildError('Circular dependency between: ' + ', '.join(pending))
+                    break
+                finished, _ = futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    try:
+                        results[key] = future.result()
+                        done.add(key)
+                    except Exception as e:
+                        if error is None: error = e
+                        # Same as a serial install, a failed package isn't left half installed
+                        if key in self.cleanups: self.cleanups[key]()
+        if error is not None: raise error
+        return [results[key] for key in self.order if key in results]
@@ -0,0 +1,67 @@
+import os, re, json, hashlib, threading
+
+import cget.util as util
+import cget.binary as binary
+
+# Results that only depend on the compiler and the platform: the checks cmake runs itself (ie FindThreads) and type sizes.
+# Header, library and symbol checks of packages also depend on what is in the prefix and on CMAKE_REQUIRED_*.
+CHECK_PATTERN = re.compile(r'^((?:CMAKE_HAVE_|HAVE_SIZEOF_|SIZEOF_)\w+):INTERNAL=(.*)$')
+SEED_PATTERN = re.compile(r'^set\((\w+) (".*") CACHE INTERNAL ""\)$')
+FALSE_VALUES = ['', '0', 'OFF', 'NO', 'FALSE', 'N', 'IGNORE', 'NOTFOUND']
+
+def is_positive(value):
+    value = value.upper()
+    return value not in FALSE_VALUES and not value.endswith('-NOTFOUND')
+
+def parse_check_results(cache_file):
+    result = {}
+    if not os.path.isfile(cache_file): return result
+    with open(cache_file) as f:
+        for line in f:
+            m = CHECK_PATTERN.match(line.strip())
+            # A failed check could pass later, so only successes are shared
+            if m and is_positive(m.group(2)): result[m.group(1)] = m.group(2)
+    # check_type_size needs the size along with HAVE_SIZEOF_*
+    return dict((k, v) for k, v in result.items() if not (
+        (k.startswith('HAVE_SIZEOF_') and k[len('HAVE_'):] not in result) or
+        (k.startswith('SIZEOF_') and 'HAVE_' + k not in result)
+    ))
+
+def get_toolchain_fingerprint(toolchain):
+    data = [binary.hash_file(toolchain), [binary.get_compiler_id(c) for c in binary.get_compilers()]]
+    return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+class SeedCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def get_path(self, fingerprint):
+        return os.path.join(self.path, fingerprint + '.cmake')
+
+    def get(self, fingerprint):
+        p = self.get_path(fingerprint)
+        if os.path.isfile(p): return p
+        return None
+
+    def load(self, fingerprint):
+        p = self.get_path(fingerprint)
+        if not os.path.isfile(p): return {}
+        with open(p) as f:
+            return dict((m.group(1), json.loads(m.group(2))) for m in (SEED_PATTERN.match(line.strip()) for line in f) if m)
+
+    def update(self, fingerprint, results):
+        with self.lock:
+            seed = self.load(fingerprint)
+            # The first package to run a check decides its result
+            added = dict((k, v) for k, v in results.items() if k not in seed)
+            if not added: return self.get(fingerprint)
+            seed.update(added)
+            lines = ['set({0} {1} CACHE INTERNAL "")'.format(k, util.quote(seed[k])) for k in sorted(seed)]
+            p = self.get_path(fingerprint)
+            tmp = '{0}.{1}.tmp'.format(p, os.getpid())
+            util.mkdir(self.path)
+            util.write_to(tmp, lines)
+            os.replace(tmp, p)
+            return p
@@ -1,8 +1,8 @@
-import click, os, sys, shutil, json, six, hashlib, ssl
+import click, os, sys, errno, shutil, json, six, hashlib, ssl, contextlib, time, threading, tempfile, multiprocessing, fnmatch
+from concurrent import futures
 
 if sys.version_info[0] < 3:
     try:
-        import contextlib
         import lzma
     except:
         try:
@@ -11,15 +11,26 @@ if sys.version_info[0] < 3:
             pass
 import tarfile, zipfile
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 if os.name == 'posix' and sys.version_info[0] < 3:
     import subprocess32 as subprocess
 else:
     import subprocess
 
 from six.moves.urllib import request
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urlparse, urljoin
+from six.moves import http_client
 
 USE_SYMLINKS=(os.name == 'posix')
 USE_CMAKE_TAR=(os.name != 'posix')
+CHUNK_SIZE=1 << 20
+# ioctl to share the extents of a file on btrfs/xfs/ocfs2
+FICLONE=0x40049409
 
 __CGET_DIR__ = os.path.dirname(os.path.realpath(__file__))
 
@@ -94,41 +105,104 @@ def get_app_dir(*args):
 def get_cache_path(*args):
     return get_app_dir('cache', *args)
 
-def add_cache_file(key, f):
-    mkdir(get_cache_path(key))
-    shutil.copy2(f, get_cache_path(key, os.path.basename(f)))
-
-def get_cache_file(key):
-    p = get_cache_path(key)
-    if os.path.exists(p):
-        return os.path.join(p, next(ls(p)))
-    else:
-        return None
-
 def delete_dir(path):
     if path is not None and os.path.exists(path): shutil.rmtree(path)
 
-def symlink_dir(src, dst):
-    for root, dirs, files in os.walk(src):
-        all_files = (
-            file 
-            for x in [dirs, files] 
-            for file in x 
-            if os.path.islink(os.path.join(root, file)) or os.path.isfile(os.path.join(root, file))
-        )
-        for file in all_files:
-            path = os.path.relpath(root, src)
-            d = os.path.join(dst, path)
-            mkdir(d)
-            os.symlink(os.path.join(root, file), os.path.join(d, file))
-
-def copy_dir(src, dst):
-    for root, dirs, files in os.walk(src):
-        for file in files:
-            path = os.path.relpath(root, src)
-            d = os.path.join(dst, path)
-            mkdir(d)
-            shutil.copy2(os.path.join(root, file), os.path.join(d, file))
+@contextlib.contextmanager
+def staging_dir(dst):
+    # Stage next to the destination so the final rename stays on the same filesystem
+    parent = mkdir(os.path.dirname(os.path.abspath(dst)))
+    d = tempfile.mkdtemp(prefix='.cget-tmp-', dir=parent)
+    try:
+        yield d
+    finally:
+        delete_dir(d)
+
+def replace_dir(src, dst):
+    old = None
+    if os.path.lexists(dst):
+        old = tempfile.mkdtemp(prefix='.cget-old-', dir=os.path.dirname(os.path.abspath(dst)))
+        os.rename(dst, os.path.join(old, 'dir'))
+    os.rename(src, dst)
+    delete_dir(old)
+    return dst
+
+def scan_link_dirs(src, rel=''):
+    # Yields each directory with its files and its links, relying on the types cached by scandir instead of a stat per file
+    files = []
+    links = []
+    dirs = []
+    with os.scandir(os.path.join(src, rel) if rel else src) as it:
+        for entry in it:
+            path = os.path.join(rel, entry.name) if rel else entry.name
+            if entry.is_symlink(): links.append(path)
+            elif entry.is_file(follow_symlinks=False): files.append(path)
+            elif entry.is_dir(follow_symlinks=False): dirs.append(path)
+    yield rel, files, links
+    for d in dirs:
+        for x in scan_link_dirs(src, d): yield x
+
+def get_link_files(src):
+    for d, files, links in scan_link_dirs(src):
+        for file in files + links: yield file
+
+def link_dir(src, dst, link, jobs=None, copy_links=False, empty_dirs=False):
+    # With copy_links, links inside the tree are recreated instead of linked or followed
+    batches = [(d, [(f, link) for f in files] + [(f, copy_symlink if copy_links else link) for f in links])
+        for d, files, links in scan_link_dirs(src) if files or links or empty_dirs]
+    # Each directory is created once, before any worker needs it
+    for d, entries in batches: mkdir(os.path.join(dst, d))
+    def link_batch(batch):
+        result = []
+        for path, f_link in batch[1]:
+            f = os.path.join(dst, path)
+            f_link(os.path.join(src, path), f)
+            result.append(f)
+        return result
+    if jobs and jobs > 1 and len(batches) > 1:
+        with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            return [f for files in executor.map(link_batch, batches) for f in files]
+    return [f for batch in batches for f in link_batch(batch)]
+
+def symlink_dir(src, dst, jobs=None):
+    return link_dir(src, dst, os.symlink, jobs=jobs)
+
+def fold_dir(src, dst, unfold, rel=''):
+    # Links a directory as a whole unless another package already has it, top-level directories are always shared
+    result = []
+    with os.scandir(os.path.join(src, rel) if rel else src) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    if entries: mkdir(os.path.join(dst, rel))
+    for entry in entries:
+        path = os.path.join(rel, entry.name) if rel else entry.name
+        f = os.path.join(dst, path)
+        if entry.is_dir(follow_symlinks=False):
+            if not os.path.lexists(f) and rel:
+                os.symlink(os.path.join(src, path), f)
+                result.append(f)
+                continue
+            if os.path.islink(f) and os.path.isdir(f): unfold(f)
+            result.extend(fold_dir(src, dst, unfold, path))
+        elif entry.is_symlink() or entry.is_file(follow_symlinks=False):
+            os.symlink(os.path.join(src, path), f)
+            result.append(f)
+    return result
+
+def unfold_link(link):
+    # Replaces a link to a directory with a directory of links to its entries
+    target = os.path.join(os.path.dirname(link), os.readlink(link))
+    os.remove(link)
+    os.mkdir(link)
+    result = []
+    with os.scandir(target) as it:
+        for entry in it:
+            f = os.path.join(link, entry.name)
+            os.symlink(os.path.join(target, entry.name), f)
+            result.append(f)
+    return result
+
+def copy_dir(src, dst, jobs=None):
+    return link_tree(src, dst, 'copy', jobs=jobs)
 
 def rm_symlink(file):
     if os.path.islink(file):
@@ -172,94 +246,657 @@ def rm_empty_dirs(d):
     if not has_files: os.rmdir(d)
     return has_files
 
+def rm_empty_parents(files, top):
+    # Only the directories that held these files can have become empty
+    top = os.path.abspath(top)
+    for d in sorted(set(os.path.dirname(f) for f in files), key=len, reverse=True):
+        while d.startswith(top + os.sep):
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+            d = os.path.dirname(d)
+
 def get_dirs(d):
     return (os.path.join(d,o) for o in os.listdir(d) if os.path.isdir(os.path.join(d,o)))
 
 def copy_to(src, dst_dir):
     target = os.path.join(dst_dir, os.path.basename(src))
-    if os.path.isfile(src): shutil.copyfile(src, target)
+    if os.path.isfile(src): 
+        # Never write through an existing target, it may be hardlinked into the cache
+        if os.path.isfile(target): os.remove(target)
+        shutil.copyfile(src, target)
     else: shutil.copytree(src, target)
     return target
 
+def reflink(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+def clone_file(src, dst):
+    if os.path.lexists(dst): os.remove(dst)
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        pass
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            reflink(src, dst)
+            return dst
+        except (IOError, OSError):
+            if os.path.exists(dst): os.remove(dst)
+    # Only copy the data when the file can't be shared, ie across devices
+    shutil.copy2(src, dst)
+    return dst
+
+def copy_symlink(src, dst):
+    os.symlink(os.readlink(src), dst)
+
+def copy_file_data(src, dst):
+    copy_range = getattr(os, 'copy_file_range', None)
+    size = os.fstat(src).st_size
+    offset = 0
+    # The data is copied in the kernel, without going through python buffers
+    while offset < size:
+        try:
+            if copy_range: n = copy_range(src, dst, size - offset)
+            else: n = os.sendfile(dst, src, offset, size - offset)
+        except OSError as e:
+            # Not supported across these filesystems, so fall back to sendfile
+            if copy_range and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                copy_range = None
+                continue
+            raise
+        if n == 0: break
+        offset = offset + n
+    return offset
+
+def copy_file(src, dst):
+    if not hasattr(os, 'sendfile'): return shutil.copy2(src, dst)
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            copy_file_data(s.fileno(), d.fileno())
+        except OSError:
+            # sendfile can't write to every kind of file everywhere
+            s.seek(0)
+            d.seek(0)
+            d.truncate()
+            shutil.copyfileobj(s, d)
+    shutil.copystat(src, dst)
+    return dst
+
+def hardlink_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Across devices a copy is the best that can be done
+        copy_file(src, dst)
+    return dst
+
+def reflink_file(src, dst):
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            reflink(src, dst)
+            return dst
+        except (IOError, OSError):
+            # Not every filesystem can share extents, and copying over dst truncates it anyway
+            pass
+    return copy_file(src, dst)
+
+LINK_MODES = ['symlink', 'hardlink', 'reflink', 'copy']
+LINK_FUNCTIONS = {'hardlink': hardlink_file, 'reflink': reflink_file, 'copy': copy_file}
+
+def get_default_link_mode():
+    return 'symlink' if USE_SYMLINKS else 'copy'
+
+def link_tree(src, dst, mode='symlink', jobs=None):
+    if mode == 'symlink': return symlink_dir(src, dst, jobs=jobs)
+    if mode not in LINK_FUNCTIONS: raise BuildError("Unknown link mode: {}".format(mode))
+    return link_dir(src, dst, LINK_FUNCTIONS[mode], jobs=jobs or multiprocessing.cpu_count(), copy_links=True)
+
+def clone_writable_file(src, dst):
+    reflink_file(src, dst)
+    os.chmod(dst, os.stat(dst).st_mode | 0o200)
+    return dst
+
+def clone_dir(src, dst, jobs=None):
+    # Shares the data copy-on-write where the filesystem can, so writes to the clone never reach src
+    return link_dir(src, dst, clone_writable_file, jobs=jobs or multiprocessing.cpu_count(), copy_links=True, empty_dirs=True)
+
+def make_read_only(d):
+    if os.name != 'posix': return
+    for root, dirs, files in os.walk(d):
+        for file in files:
+            p = os.path.join(root, file)
+            if not os.path.islink(p): os.chmod(p, os.stat(p).st_mode & ~0o222)
+
+HEADER_PATTERNS = ['*.h', '*.hpp', '*.hh', '*.hxx']
+
+def is_header(name):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in HEADER_PATTERNS)
+
+def copy_files(files, jobs=None):
+    # Create the directories up front so the workers don't race on them
+    for d in set(os.path.dirname(dst) for dst in files): mkdir(d)
+    def copy(dst):
+        if os.path.lexists(dst): os.remove(dst)
+        shutil.copyfile(files[dst], dst)
+    with futures.ThreadPoolExecutor(max_workers=jobs or multiprocessing.cpu_count()) as executor:
+        list(executor.map(copy, files))
+    return sorted(files)
+
 def symlink_to(src, dst_dir):
     target = os.path.join(dst_dir, os.path.basename(src))
     os.symlink(src, target)
     return target
 
-class CGetURLOpener(request.FancyURLopener):
-    def http_error_default(self, url, fp, errcode, errmsg, headers):
-        if errcode >= 400:
-            raise BuildError("Download failed with error {0} for: {1}".format(errcode, url))
-        return request.FancyURLopener.http_error_default(self, url, fp, errcode, errmsg, headers)
+SIZE_UNITS = ['B', 'K', 'M', 'G', 'T']
+
+def format_size(n):
+    for unit in SIZE_UNITS:
+        if n < 1024 or unit == SIZE_UNITS[-1]: break
+        n = n / 1024.0
+    if unit == 'B': return '{}B'.format(int(n))
+    return '{:.1f}{}iB'.format(n, unit)
+
+class DownloadProgress:
+    def __init__(self, total=0, initial=0, enabled=True):
+        self.total = total
+        self.initial = initial
+        self.done = initial
+        self.enabled = enabled
+        self.start = time.time()
+        self.shown = 0
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.done += n
+            now = time.time()
+            if self.enabled and now - self.shown > 0.25:
+                self.shown = now
+                self.show(now)
+
+    def show(self, now):
+        rate = (self.done - self.initial) / max(now - self.start, 1e-3)
+        s = format_size(self.done)
+        if self.total: s += ' / ' + format_size(self.total)
+        s += '  {}/s'.format(format_size(rate))
+        if self.total and rate > 0:
+            eta = int(max(self.total - self.done, 0) / rate)
+            s += '  ETA {}:{:02d}:{:02d}'.format(eta // 3600, (eta // 60) % 60, eta % 60)
+        click.echo('\r' + s.ljust(60), nl=False)
+
+    def finish(self):
+        if self.enabled:
+            self.show(time.time())
+            click.echo('')
+
+class PooledResponse:
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.headers = response.headers
+
+    def getcode(self):
+        return self.response.status
+
+    def read(self, n=None):
+        return self.response.read(n)
+
+    def drain(self):
+        self.response.read()
+        self.close()
+
+    def close(self):
+        if self.conn is None: return
+        # The connection can only be reused once the whole body has been read
+        reuse = self.response.isclosed() and not self.response.will_close
+        self.response.close()
+        self.pool.release(self.key, self.conn, reuse)
+        self.conn = None
+
+class HTTPConnectionPool:
+    def __init__(self, max_per_host=None, timeout=60):
+        self.max_per_host = int(max_per_host or os.environ.get('CGET_HTTP_CONNECTIONS') or 4)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.limits = {}
+        self.connections = 0
+
+    def connect(self, key):
+        scheme, netloc, insecure = key
+        with self.lock: self.connections += 1
+        if scheme == 'https':
+            context = ssl._create_unverified_context() if insecure else ssl.create_default_context()
+            return http_client.HTTPSConnection(netloc, timeout=self.timeout, context=context)
+        return http_client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def acquire(self, key):
+        with self.lock:
+            limit = self.limits.setdefault(key, threading.BoundedSemaphore(self.max_per_host))
+        limit.acquire()
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle: return idle.pop(), True
+        return self.connect(key), False
+
+    def release(self, key, conn, reuse=True):
+        if reuse:
+            with self.lock: self.idle.setdefault(key, []).append(conn)
+        else: conn.close()
+        self.limits[key].release()
+
+    def send(self, key, path, headers=None, method='GET', body=None):
+        conn, reused = self.acquire(key)
+        try:
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                return conn, conn.getresponse()
+            except (http_client.HTTPException, IOError, OSError):
+                conn.close()
+                if not reused: raise
+            # The server dropped an idle keep-alive connection, so retry on a new one
+            conn = self.connect(key)
+            if hasattr(body, 'seek'): body.seek(0)
+            conn.request(method, path, body=body, headers=headers or {})
+            return conn, conn.getresponse()
+        except:
+            self.release(key, conn, reuse=False)
+            raise
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conn in (conn for conns in idle.values() for conn in conns): conn.close()
+
+    def split(self, url, insecure=False):
+        parts = urlparse(url)
+        path = parts.path or '/'
+        if parts.query: path = path + '?' + parts.query
+        return (parts.scheme, parts.netloc, insecure), path
+
+    def put(self, url, body, headers=None, insecure=False):
+        key, path = self.split(url, insecure)
+        conn, r = self.send(key, path, headers=headers, method='PUT', body=body)
+        PooledResponse(self, key, conn, r).drain()
+        if r.status >= 400:
+            raise BuildError("Upload failed with error {0} for: {1}".format(r.status, url))
+
+    def open(self, url, headers=None, insecure=False):
+        for i in range(10):
+            key, path = self.split(url, insecure)
+            conn, r = self.send(key, path, headers=headers)
+            response = PooledResponse(self, key, conn, r)
+            location = r.getheader('Location')
+            if r.status in [301, 302, 303, 307, 308] and location:
+                response.drain()
+                url = urljoin(url, location)
+            elif r.status >= 400:
+                response.drain()
+                raise BuildError("Download failed with error {0} for: {1}".format(r.status, url))
+            else:
+                return response
+        raise BuildError("Too many redirects for: {0}".format(url))
+
+__HTTP_POOL__ = HTTPConnectionPool()
+
+def get_http_pool():
+    return __HTTP_POOL__
+
+def open_url(url, headers=None, insecure=False):
+    scheme = url.split('://')[0]
+    if scheme in ['http', 'https'] and scheme not in request.getproxies():
+        return get_http_pool().open(url, headers=headers, insecure=insecure)
+    # Let urllib deal with proxies and other schemes
+    context = None
+    if insecure: context = ssl._create_unverified_context()
+    try:
+        return request.urlopen(request.Request(url, headers=headers or {}), context=context)
+    except HTTPError as e:
+        raise BuildError("Download failed with error {0} for: {1}".format(e.code, url))
+
+def upload_file(url, f, headers=None, insecure=False):
+    headers = merge({'Content-Length': str(os.path.getsize(f))}, headers)
+    with open(f, 'rb') as fp:
+        scheme = url.split('://')[0]
+        if scheme in ['http', 'https'] and scheme not in request.getproxies():
+            return get_http_pool().put(url, fp, headers=headers, insecure=insecure)
+        context = None
+        if insecure: context = ssl._create_unverified_context()
+        try:
+            request.urlopen(request.Request(url, data=fp, headers=headers, method='PUT'), context=context).close()
+        except HTTPError as e:
+            raise BuildError("Upload failed with error {0} for: {1}".format(e.code, url))
+
+class HashingReader:
+    def __init__(self, fp, hasher=None, tee=None, update=None):
+        self.fp = fp
+        self.hasher = hasher
+        self.tee = tee
+        self.update = update
+
+    def read(self, n=-1):
+        data = self.fp.read(n) if n is not None and n >= 0 else self.fp.read()
+        if data:
+            if self.hasher is not None: self.hasher.update(data)
+            if self.tee is not None: self.tee.write(data)
+            if self.update is not None: self.update(len(data))
+        return data
+
+class LimitedReader:
+    def __init__(self, fp, size):
+        self.fp = fp
+        self.size = size
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > self.size: n = self.size
+        data = self.fp.read(n) if n else b''
+        self.size = self.size - len(data)
+        return data
+
+def copy_stream(src, dst, hasher=None, update=None):
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk: break
+        dst.write(chunk)
+        if hasher is not None: hasher.update(chunk)
+        if update is not None: update(len(chunk))
+
+def get_content_length(response):
+    return int(response.headers.get('Content-Length') or 0)
+
+def download_segment(url, part, start, end, insecure=False, update=None, validator=None):
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    if validator: headers['If-Range'] = validator
+    response = open_url(url, headers=headers, insecure=insecure)
+    with contextlib.closing(response), open(part, 'r+b') as f:
+        if response.getcode() != 206 or get_range_start(response) != start:
+            raise BuildError("Server ignored range request for: {0}".format(url))
+        f.seek(start)
+        copy_stream(response, f, update=update)
+
+def download_segments(url, part, total, segments, insecure=False, update=None, validator=None):
+    with open(part, 'wb') as f: f.truncate(total)
+    size = -(-total // segments)
+    ranges = [(start, min(start + size, total) - 1) for start in range(0, total, size)]
+    try:
+        with futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            for future in [executor.submit(download_segment, url, part, start, end, insecure, update, validator) for start, end in ranges]:
+                future.result()
+    except:
+        # A file with holes can't be resumed
+        os.remove(part)
+        raise
+
+def get_part_file(url, download_dir):
+    # Named after the whole url, since different urls often end the same way (ie HEAD.tar.gz)
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(download_dir, '{0}.{1}.part'.format(url.split('/')[-1], digest))
+
+def get_validator(response):
+    etag = response.headers.get('ETag')
+    # Only a strong validator can be used with If-Range
+    if etag and not etag.startswith('W/'): return etag
+    return response.headers.get('Last-Modified')
+
+def get_range_start(response):
+    r = (response.headers.get('Content-Range') or '').split()
+    if len(r) < 2 or r[0] != 'bytes' or '-' not in r[1]: return None
+    try:
+        return int(r[1].split('-')[0])
+    except ValueError:
+        return None
 
-def download_to(url, download_dir, insecure=False):
+def open_part(url, part, insecure=False):
+    # Returns the response and the offset in the part file it continues from
+    validator = None
+    if os.path.exists(part + '.validator'):
+        with open(part + '.validator') as f: validator = f.read().strip()
+    offset = os.path.getsize(part) if validator and os.path.exists(part) else 0
+    response = None
+    if offset:
+        try:
+            response = open_url(url, headers={'Range': 'bytes={}-'.format(offset), 'If-Range': validator}, insecure=insecure)
+        except BuildError:
+            pass
+        if response is not None and response.getcode() == 206 and get_range_start(response) == offset: return response, offset
+        # The server sends the whole file when it has changed since
+        if response is not None and response.getcode() != 200:
+            response.close()
+            response = None
+    # Anything but the exact continuation starts again from the beginning
+    for f in [part, part + '.validator']:
+        if os.path.exists(f): os.remove(f)
+    if response is None: response = open_url(url, insecure=insecure)
+    validator = get_validator(response)
+    if validator: write_to(part + '.validator', [validator])
+    return response, 0
+
+def download_to(url, download_dir, insecure=False, progress=True, hasher=None, segments=None):
     name = url.split('/')[-1]
     file = os.path.join(download_dir, name)
+    part = get_part_file(url, download_dir)
+    segments = int(segments or os.environ.get('CGET_DOWNLOAD_SEGMENTS') or 1)
     click.echo("Downloading {0}".format(url))
-    bar_len = 1000
-    with click.progressbar(length=bar_len, width=70) as bar:
-        def hook(count, block_size, total_size):
-            percent = int(count*block_size*bar_len/total_size)
-            if percent > 0 and percent < bar_len: 
-                # Hack because we can't set the position
-                bar.pos = percent
-                bar.update(0)
-        context = None
-        if insecure: context = ssl._create_unverified_context()
-        CGetURLOpener(context=context).retrieve(url, filename=file, reporthook=hook, data=None)
-        bar.update(bar_len)
-    if not os.path.exists(file):
-        raise BuildError("Download failed for: {0}".format(url))
+    # Resume from a previous partial download
+    response, offset = open_part(url, part, insecure=insecure)
+    total = offset + get_content_length(response)
+    bar = DownloadProgress(total, initial=offset, enabled=progress)
+    with contextlib.closing(response):
+        if segments > 1 and not offset and total >= segments * CHUNK_SIZE and response.headers.get('Accept-Ranges') == 'bytes':
+            response.close()
+            download_segments(url, part, total, segments, insecure=insecure, update=bar.update, validator=get_validator(response))
+            if hasher is not None: update_hash_file(hasher, part)
+        else:
+            if offset and hasher is not None: update_hash_file(hasher, part)
+            with open(part, 'ab' if offset else 'wb') as f:
+                # The hash is computed as the bytes arrive so there is no second pass over the file
+                copy_stream(response, f, hasher=hasher, update=bar.update)
+    bar.finish()
+    if total and os.path.getsize(part) != total:
+        raise BuildError("Download incomplete for: {0}".format(url))
+    # Replace rather than overwrite so a previous download shared with the cache stays intact
+    os.replace(part, file)
+    if os.path.exists(part + '.validator'): os.remove(part + '.validator')
     return file
 
 
+STREAM_EXTENSIONS = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+
+def stream_extract(url, dst, tee, hasher=None, insecure=False, progress=True, select=None):
+    click.echo("Downloading and extracting {0}".format(url))
+    response = open_url(url, insecure=insecure)
+    bar = DownloadProgress(get_content_length(response), enabled=progress)
+    with contextlib.closing(response), open(tee, 'wb') as f:
+        # Members are written out while the rest of the archive is still arriving
+        reader = HashingReader(response, hasher=hasher, tee=f, update=bar.update)
+        with tarfile.open(fileobj=reader, mode='r|*') as ar:
+            extract_tar(ar, dst, select=select)
+        # Read any trailing padding so the digest covers the whole archive
+        while reader.read(CHUNK_SIZE): pass
+    bar.finish()
+    return dst
+
+
 def transfer_to(f, dst, copy=False):
     if USE_SYMLINKS and not copy: return symlink_to(f, dst)
     else: return copy_to(f, dst)
 
 
-def retrieve_url(url, dst, copy=False, insecure=False, hash=None):
+def retrieve_url(url, dst, copy=False, insecure=False, hash=None, progress=True, cache=None):
     remote = not url.startswith('file://')
+    key = hash and get_hash_key(hash)
     # Retrieve from cache
-    if remote and hash:
-        f = get_cache_file(hash.replace(':', '-'))
-        if f: return f
-    f = download_to(url, dst, insecure=insecure) if remote else transfer_to(url[7:], dst, copy=copy)
+    if remote and hash and cache is not None:
+        f = cache.get(key)
+        if f: return clone_file(f, os.path.join(dst, os.path.basename(f)))
+    hasher = None
+    if remote and hash: hasher = hashlib.new(hash.lower().split(':')[0])
+    f = download_to(url, dst, insecure=insecure, progress=progress, hasher=hasher) if remote else transfer_to(url[7:], dst, copy=copy)
     if os.path.isfile(f) and hash:
         click.echo("Computing hash: {}".format(hash))
-        if check_hash(f, hash): 
-            if remote: add_cache_file(hash.replace(':', '-'), f)
+        if check_hash(f, hash, digest=hasher and hasher.hexdigest()): 
+            if remote and cache is not None: cache.add(key, f)
         else:
+            # Don't let a bad download be resumed
+            if remote: os.remove(f)
             raise BuildError("Hash doesn't match for {0}: {1}".format(url, hash))
     return f
 
-def extract_ar(archive, dst, *kwargs):
+# Parallel decompressors to use when they are available, in order of preference
+DECOMPRESSORS = [
+    (['.tar.gz', '.tgz'], [['pigz', '-dc']]),
+    (['.tar.xz', '.txz'], [['xz', '-T0', '-dc']]),
+    (['.tar.bz2', '.tbz2'], [['lbzip2', '-dc'], ['pbzip2', '-dc']]),
+    (['.tar.zst', '.tzst'], [['zstd', '-T0', '-dc']])
+]
+
+def get_member_paths(name):
+    # Globs are matched relative to the archive's top-level directory
+    parts = [x for x in name.replace('\\', '/').split('/') if x not in ['', os.path.curdir]][1:]
+    return ['/'.join(parts[:i+1]) for i in range(len(parts))]
+
+def member_filter(include=None, exclude=None):
+    if not include and not exclude: return None
+    def match(paths, globs):
+        return any(fnmatch.fnmatch(p, g) for p in paths for g in globs)
+    def select(name):
+        paths = get_member_paths(name)
+        if not paths: return True
+        # Matching a directory also matches everything below it
+        if exclude and match(paths, exclude): return False
+        return not include or match(paths, include)
+    return select
+
+def extract_tar(ar, dst, select=None):
+    # Iterating the members keeps this working on streams as well
+    ar.extractall(dst, members=(m for m in ar if select(m.name)) if select else None)
+
+def get_decompressor(archive):
+    for exts, cmds in DECOMPRESSORS:
+        if any(archive.endswith(ext) for ext in exts):
+            for c in cmds:
+                exe = which(c[0], throws=False)
+                if exe: return [exe] + c[1:]
+    return None
+
+def extract_tar_pipe(decompressor, archive, dst, select=None):
+    child = subprocess.Popen(decompressor + [archive], stdout=subprocess.PIPE)
+    try:
+        # Decompression runs in another process while the members are written out here
+        with tarfile.open(fileobj=child.stdout, mode='r|') as f:
+            extract_tar(f, dst, select=select)
+    finally:
+        child.stdout.close()
+        child.wait()
+    if child.returncode != 0:
+        raise BuildError(msg='Command failed: ' + ' '.join(decompressor + [archive]))
+
+def extract_zip_members(archive, dst, names):
+    with zipfile.ZipFile(archive, 'r') as f:
+        for name in names:
+            f.extract(name, dst)
+
+def get_zip_member_dir(dst, name):
+    # Same sanitizing as ZipFile.extract
+    parts = [x for x in name.replace('/', os.path.sep).split(os.path.sep) if x not in ['', os.path.curdir, os.path.pardir]]
+    if not name.endswith('/'): parts = parts[:-1]
+    return os.path.join(dst, *parts)
+
+def extract_zip(archive, dst, jobs=None, select=None):
+    with zipfile.ZipFile(archive, 'r') as f:
+        infos = [info for info in f.infolist() if select is None or select(info.filename)]
+    # Create the directories up front so the workers don't race on them
+    for d in set(get_zip_member_dir(dst, info.filename) for info in infos): mkdir(d)
+    infos = [info for info in infos if not info.filename.endswith('/')]
+    jobs = min(jobs or multiprocessing.cpu_count(), len(infos)) or 1
+    # Balance the workers by the amount of data each one decompresses
+    buckets = [[] for i in range(jobs)]
+    sizes = [0] * jobs
+    for info in sorted(infos, key=lambda i: i.file_size, reverse=True):
+        i = sizes.index(min(sizes))
+        buckets[i].append(info.filename)
+        sizes[i] += info.file_size
+    # Each worker needs its own handle since ZipFile isn't thread safe
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [executor.submit(extract_zip_members, archive, dst, names) for names in buckets]:
+            future.result()
+
+def extract_ar(archive, dst, jobs=None, select=None):
+    decompressor = None if USE_CMAKE_TAR else get_decompressor(archive)
     if sys.version_info[0] < 3 and archive.endswith('.xz'):
         with contextlib.closing(lzma.LZMAFile(archive)) as xz:
-            with tarfile.open(fileobj=xz, *kwargs) as f:
-                f.extractall(dst)
+            with tarfile.open(fileobj=xz) as f:
+                extract_tar(f, dst, select=select)
     elif archive.endswith('.zip'):
-        with zipfile.ZipFile(archive,'r') as f:
-            f.extractall(dst)
+        extract_zip(archive, dst, jobs=jobs, select=select)
+    elif decompressor:
+        extract_tar_pipe(decompressor, os.path.abspath(archive), dst, select=select)
     elif tarfile.is_tarfile(archive):
-        if USE_CMAKE_TAR:
+        # cmake can't skip members so filtered archives are always extracted here
+        if USE_CMAKE_TAR and select is None:
             cmd([which('cmake'), '-E', 'tar', 'xzf', os.path.abspath(archive)], cwd=dst)
         else:
-            tarfile.open(archive, *kwargs).extractall(dst)
+            with tarfile.open(archive) as f:
+                extract_tar(f, dst, select=select)
     else:
         # Treat as a single source file
         d = os.path.join(dst, 'header')
         mkdir(d)
         copy_to(archive, d)
 
+def update_hash_file(h, f):
+    with open(f, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h
+
 def hash_file(f, t):
-    h = hashlib.new(t)
-    h.update(open(f, 'rb').read())
-    return h.hexdigest()
+    return update_hash_file(hashlib.new(t), f).hexdigest()
+
+def get_hash_key(hash):
+    # Caches and the store share one spelling of a hash, whatever case it was written in
+    return hash.lower().replace(':', '-')
 
-def check_hash(f, hash):
+def check_hash(f, hash, digest=None):
     t, h = hash.lower().split(':')
-    return hash_file(f, t) == h
+    return (digest or hash_file(f, t)) == h
+
+CONFIGURE_FINGERPRINT_FILE = '__cget_configure_fingerprint__.txt'
+CONFIGURE_ENV = ['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'LDFLAGS', 'CMAKE_PREFIX_PATH', 'PKG_CONFIG_PATH']
+
+def is_cmake_file(name):
+    return name == 'CMakeLists.txt' or name.endswith('.cmake') or name.endswith('.cmake.in')
+
+def get_configure_fingerprint(args, src_dir, files=None):
+    h = hashlib.sha256()
+    h.update(json.dumps([list(args), [os.environ.get(e) for e in CONFIGURE_ENV]]).encode('utf-8'))
+    for f in files or []:
+        h.update(f.encode('utf-8'))
+        if os.path.isfile(f): update_hash_file(h, f)
+    for root, dirs, names in os.walk(src_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(filter(is_cmake_file, names)):
+            p = os.path.join(root, name)
+            h.update(os.path.relpath(p, src_dir).encode('utf-8'))
+            update_hash_file(h, p)
+    return h.hexdigest()
+
+def is_configured(build_dir, fingerprint):
+    f = os.path.join(build_dir, CONFIGURE_FINGERPRINT_FILE)
+    if not os.path.isfile(os.path.join(build_dir, 'CMakeCache.txt')) or not os.path.isfile(f): return False
+    with open(f) as fp: return fp.read().strip() == fingerprint
+
+def set_configured(build_dir, fingerprint):
+    f = os.path.join(build_dir, CONFIGURE_FINGERPRINT_FILE)
+    if fingerprint: write_to(f, [fingerprint])
+    elif os.path.exists(f): os.remove(f)
 
 def which(p, paths=None, throws=True):
     exes = [p+x for x in ['', '.exe', '.bat']]
@@ -271,6 +908,20 @@ def which(p, paths=None, throws=True):
     if throws: raise BuildError("Can't find file %s" % p)
     else: return None
 
+COMPILER_LAUNCHERS = ['ccache', 'sccache']
+LAUNCHER_STATS_ARGS = {'ccache': ['-s'], 'sccache': ['--show-stats']}
+
+def find_launcher(name='auto'):
+    if not name or name == 'none': return None
+    if name != 'auto': return which(name)
+    for launcher in COMPILER_LAUNCHERS:
+        exe = which(launcher, throws=False)
+        if exe: return exe
+    return None
+
+def get_launcher_name(launcher):
+    return os.path.splitext(os.path.basename(launcher))[0]
+
 def merge(*args):
     result = {}
     for d in args:
@@ -289,7 +940,7 @@ def yield_from(f):
     return g
 
 def cmd(args, env=None, **kwargs):
-    #e = merge(os.environ, env)
+    if env: kwargs['env'] = as_dict_str(merge(os.environ, env))
     child = subprocess.Popen(args, **kwargs)
     child.communicate()
     if child.returncode != 0: 
@@ -0,0 +1,79 @@
+import argparse, os, random, shutil, tarfile, tempfile, time, zipfile
+
+import cget.util
+
+
+def make_tree(root, files, size):
+    rng = random.Random(0)
+    words = [''.join(rng.choice('abcdefghij') for _ in range(8)) for _ in range(512)]
+    for i in range(files):
+        d = os.path.join(root, 'pkg', 'dir{}'.format(i % 50))
+        cget.util.mkdir(d)
+        with open(os.path.join(d, 'file{}.txt'.format(i)), 'w') as f:
+            f.write(' '.join(rng.choice(words) for _ in range(rng.randint(1, size // 4))))
+
+
+def make_archives(root, tmp):
+    zip_ar = os.path.join(tmp, 'pkg.zip')
+    with zipfile.ZipFile(zip_ar, 'w', zipfile.ZIP_DEFLATED) as f:
+        for r, dirs, files in os.walk(os.path.join(root, 'pkg')):
+            for file in files:
+                p = os.path.join(r, file)
+                f.write(p, os.path.relpath(p, root))
+    result = [zip_ar]
+    for mode, ext in [('w:gz', '.tar.gz'), ('w:xz', '.tar.xz')]:
+        ar = os.path.join(tmp, 'pkg' + ext)
+        with tarfile.open(ar, mode) as f:
+            f.add(os.path.join(root, 'pkg'), arcname='pkg')
+        result.append(ar)
+    return result
+
+
+def serial_extract(archive, dst):
+    if archive.endswith('.zip'):
+        with zipfile.ZipFile(archive) as f: f.extractall(dst)
+    else:
+        with tarfile.open(archive) as f: f.extractall(dst)
+
+
+def tree_digest(root):
+    result = {}
+    for r, dirs, files in os.walk(root):
+        for file in files:
+            p = os.path.join(r, file)
+            result[os.path.relpath(p, root)] = cget.util.hash_file(p, 'sha1')
+    return result
+
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare serial extraction against cget.util.extract_ar')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=16384, help='Maximum file size in bytes')
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        make_tree(os.path.join(tmp, 'src'), args.files, args.size)
+        for archive in make_archives(os.path.join(tmp, 'src'), tmp):
+            serial_dst = os.path.join(tmp, 'serial')
+            parallel_dst = os.path.join(tmp, 'parallel')
+            serial = timed(serial_extract, archive, serial_dst)
+            parallel = timed(cget.util.extract_ar, archive, parallel_dst)
+            identical = tree_digest(serial_dst) == tree_digest(parallel_dst)
+            name = os.path.basename(archive)
+            tool = cget.util.get_decompressor(archive) or ['python']
+            print('{:<12} {:<10} serial {:7.3f}s  extract_ar {:7.3f}s  speedup {:5.2f}x  identical {}'.format(
+                name, os.path.basename(tool[0]), serial, parallel, serial / max(parallel, 1e-6), identical))
+            shutil.rmtree(serial_dst)
+            shutil.rmtree(parallel_dst)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse, collections, contextlib, os, shutil, tempfile, time
+
+import cget.util
+
+COUNTED = ['stat', 'lstat', 'mkdir', 'symlink', 'scandir']
+
+
+def make_tree(root, files, depth):
+    for i in range(files):
+        parts = ['dir{}'.format((i // 100) % (10 ** (n + 1))) for n in range(depth)]
+        d = os.path.join(root, 'include', *parts) if i % 4 else os.path.join(root, 'lib')
+        cget.util.mkdir(d)
+        with open(os.path.join(d, 'file{}.h'.format(i)), 'w'): pass
+
+
+def walk_symlink_dir(src, dst):
+    # The os.walk based linker this benchmark compares against
+    result = []
+    for root, dirs, files in os.walk(src):
+        for file in dirs + files:
+            p = os.path.join(root, file)
+            if not (os.path.islink(p) or os.path.isfile(p)): continue
+            f = os.path.join(dst, os.path.relpath(p, src))
+            cget.util.mkdir(os.path.dirname(f))
+            os.symlink(p, f)
+            result.append(f)
+    return result
+
+
+@contextlib.contextmanager
+def count_calls():
+    counts = collections.Counter()
+    saved = dict((name, getattr(os, name)) for name in COUNTED)
+    def wrap(name, f):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return f(*args, **kwargs)
+        return wrapper
+    for name, f in saved.items(): setattr(os, name, wrap(name, f))
+    try:
+        yield counts
+    finally:
+        for name, f in saved.items(): setattr(os, name, f)
+
+
+def run(f, src, dst):
+    with count_calls() as counts:
+        start = time.time()
+        files = f(src, dst)
+        elapsed = time.time() - start
+    return elapsed, counts, sorted(os.path.relpath(x, dst) for x in files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare an os.walk linker against the link modes of cget.util.link_tree')
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--depth', type=int, default=3, help='Depth of the include directories')
+    parser.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, 'install')
+        make_tree(src, args.files, args.depth)
+        linkers = [
+            ('os.walk', walk_symlink_dir),
+            ('symlink_dir', lambda s, d: cget.util.symlink_dir(s, d, jobs=args.jobs))
+        ] + [
+            (mode, lambda s, d, mode=mode: cget.util.link_tree(s, d, mode, jobs=args.jobs))
+            for mode in cget.util.LINK_MODES if mode != 'symlink'
+        ]
+        expected = None
+        for name, f in linkers:
+            dst = os.path.join(tmp, 'prefix')
+            elapsed, counts, files = run(f, src, dst)
+            if expected is None: expected = files
+            print('{:<12} {:7.3f}s  files {:<6} {}  identical {}'.format(
+                name, elapsed, len(files), '  '.join('{} {:<6}'.format(c, counts[c]) for c in COUNTED), files == expected))
+            shutil.rmtree(dst)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
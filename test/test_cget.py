@@ -1,8 +1,9 @@
 import pytest
 
-import os, tarfile, cget.util
+import os, io, tarfile, zipfile, threading, functools, hashlib, time, cget.util, cget.scheduler, cget.jobserver, cget.prefetch, cget.cache, cget.package1, cget.binary, cget.remote, cget.cmake, cget.seed, cget.builder, cget.prefix, cget.owners, subprocess
 
 from six.moves import shlex_quote
+from six.moves import BaseHTTPServer, SimpleHTTPServer, socketserver, http_client
 
 __appveyor__ = 'APPVEYOR' in os.environ
 appveyor_skip = pytest.mark.skipif(__appveyor__, reason="Trimmed windows tests for appveyor")
@@ -74,6 +75,70 @@ class DirForTests:
 def d(tmpdir):
     return DirForTests(tmpdir.strpath)
 
+def get_test_etag(path):
+    with open(path, 'rb') as f: return '"{}"'.format(hashlib.sha1(f.read()).hexdigest())
+
+class RangeHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path): return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        self.server.requests.append(self.headers.get('Range'))
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        r = self.headers.get('Range')
+        etag = get_test_etag(path)
+        # A stale validator gets the whole file, as with any http server
+        if self.headers.get('If-Range') not in [None, etag]: r = None
+        if r:
+            first, last = r.split('=')[1].split('-')
+            start = int(first)
+            if last: end = int(last)
+            if start >= size:
+                self.send_error(416)
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return io.BytesIO(f.read(end - start + 1))
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class HTTPServerForTests:
+    def __init__(self, root):
+        self.root = root
+        handler = functools.partial(RangeHTTPRequestHandler, directory=root)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, name):
+        return 'http://127.0.0.1:{}/{}'.format(self.server.server_port, name)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def http_server(tmpdir):
+    server = HTTPServerForTests(tmpdir.mkdir('www').strpath)
+    yield server
+    server.close()
+
 def remove_empty_elements(xs):
     for x in xs:
         if x is not None:
@@ -855,3 +920,829 @@ def test_cmake_trouble(d):
         cget_cmd('install', get_exists_path('cmake-trouble')),
         cget_cmd('install', get_exists_path('libsimple'))
     ])
+
+def test_scheduler_deps_first():
+    done = []
+    s = cget.scheduler.Scheduler(jobs=4)
+    s.add('app', lambda: done.append('app'), ['liba', 'libb'])
+    s.add('liba', lambda: done.append('liba'), ['base'])
+    s.add('libb', lambda: done.append('libb'))
+    s.add('base', lambda: done.append('base'))
+    s.run()
+    assert done[-1] == 'app'
+    assert done.index('base') < done.index('liba')
+
+def test_scheduler_parallel():
+    barrier = threading.Barrier(2, timeout=10)
+    s = cget.scheduler.Scheduler(jobs=2)
+    s.add('a', barrier.wait)
+    s.add('b', barrier.wait)
+    s.run()
+
+def test_scheduler_cycle():
+    s = cget.scheduler.Scheduler(jobs=2)
+    s.add('a', lambda: None, ['b'])
+    s.add('b', lambda: None, ['a'])
+    with pytest.raises(cget.util.BuildError):
+        s.run()
+
+def test_scheduler_on_fail():
+    failed = []
+    def fail():
+        raise cget.util.BuildError('failed')
+    s = cget.scheduler.Scheduler(jobs=2)
+    s.add('a', fail, on_fail=lambda: failed.append('a'))
+    s.add('b', lambda: 'b', on_fail=lambda: failed.append('b'))
+    with pytest.raises(cget.util.BuildError):
+        s.run()
+    assert failed == ['a']
+
+@pytest.mark.skipif(os.name != 'posix', reason="Jobserver requires posix pipes")
+def test_jobserver_tokens():
+    js = cget.jobserver.JobServer(3)
+    r, w = js.get_fds()
+    assert '--jobserver-auth={},{}'.format(r, w) in js.get_env()['MAKEFLAGS']
+    assert os.read(r, 16) == b'++'
+    js.close()
+
+@pytest.mark.skipif(os.name != 'posix', reason="Jobserver requires posix fifos")
+def test_jobserver_fifo(d):
+    for name, version, expected in [('ninja', '1.13.1', True), ('ninja', '1.11.1', False), ('make', 'GNU Make 4.4.1', True), ('gmake', 'GNU Make 4.3', False), ('cc', '14.2.0', False)]:
+        exe = cget.util.mkfile(d.get_path('bin', version), name, ['#!/bin/sh', 'echo "{}"'.format(version)])
+        os.chmod(exe, 0o755)
+        assert cget.jobserver.JobServer(3).supports_fifo(exe) == expected
+    js = cget.jobserver.JobServer(3)
+    r, w = js.get_fds()
+    assert js.get_env(fifo=True)['MAKEFLAGS'] == ' -j3 --jobserver-auth=fifo:' + js.fifo
+    # Tokens written through the fifo path reach the file descriptor clients too
+    with open(js.fifo, 'wb') as f: f.write(b'+')
+    assert os.read(r, 16) == b'+++'
+    fifo = js.fifo
+    js.close()
+    assert not os.path.exists(fifo)
+
+def test_prefix_close(d, monkeypatch):
+    monkeypatch.chdir(d.tmp_dir)
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    with cget.prefix.CGetPrefix({'activeConfig': 'test', 'packages': {}}) as prefix:
+        prefix.jobserver.get_fds()
+        fifo = prefix.jobserver.fifo
+        assert os.path.exists(fifo)
+    assert not os.path.exists(os.path.dirname(fifo))
+    assert prefix.jobserver.fds is None
+
+def test_jobserver_share():
+    js = cget.jobserver.JobServer(8)
+    with js.share() as a:
+        with js.share() as b:
+            with js.share() as c:
+                assert (a, b, c) == (8, 4, 2)
+    with js.share() as a:
+        assert a == 8
+        with cget.jobserver.JobServer(1).share() as b:
+            assert b == 1
+    js.close()
+
+@pytest.mark.skipif(os.name != 'posix' or not cget.util.which('make', throws=False), reason="Requires posix make")
+def test_jobserver_total_jobs(d):
+    js = cget.jobserver.JobServer(3)
+    running = d.mkdir('running').tmp_dir
+    cget.util.mkfile(d.get_path(), 'Makefile', [
+        'all: j1 j2 j3 j4',
+        'j%:',
+        '\t@mkdir $(DIR)/$(ID)$@ && ls $(DIR) | wc -l >> $(DIR)/../counts && sleep 0.2 && rmdir $(DIR)/$(ID)$@'
+    ])
+    def build(i):
+        # Each build is a make child running in parallel with the others, like install_all does
+        with js.share():
+            subprocess.check_call(['make', '-s', 'DIR=' + running, 'ID={}'.format(i)], cwd=d.tmp_dir, env=cget.util.merge(os.environ, js.get_env()), pass_fds=js.get_fds())
+    threads = [threading.Thread(target=build, args=(i,)) for i in range(3)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    with open(d.get_path('counts')) as f: counts = [int(line) for line in f]
+    assert len(counts) == 12
+    assert 1 < max(counts) <= 3
+    # Every token is back, along with the implicit slot
+    assert os.read(js.get_fds()[0], 16) == b'++'
+    assert js.implicit
+    js.close()
+
+def test_jobserver_lend():
+    js = cget.jobserver.JobServer(1)
+    share = js.share()
+    with js.share():
+        t = threading.Thread(target=share.__enter__)
+        t.start()
+        while not js.waiting: time.sleep(0.01)
+    # With a single job, the waiting build can only get the implicit slot, through the pipe
+    t.join(5)
+    assert not t.is_alive()
+    assert js.lent == 1 and not js.implicit
+    share.__exit__(None, None, None)
+    assert js.implicit and not js.lent
+    js.close()
+
+def test_prefetch(d, http_server, monkeypatch):
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    ar = os.path.join(http_server.root, 'libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    url = http_server.url('libsimple.tar.gz')
+    prefetcher = cget.prefetch.Prefetcher(d.get_path('src-arch'), jobs=2)
+    prefetcher.prefetch(url, 'simple', hash='sha1:' + cget.util.hash_file(ar, 'sha1'))
+    f = prefetcher.get(url)
+    prefetcher.close()
+    assert cget.util.hash_file(f, 'sha1') == cget.util.hash_file(ar, 'sha1')
+    assert prefetcher.get(url) is None
+
+def test_prefetch_close(d, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    def retrieve(url, dst, **kwargs):
+        started.set()
+        release.wait(5)
+        return url
+    monkeypatch.setattr(cget.util, 'retrieve_url', retrieve)
+    prefetcher = cget.prefetch.Prefetcher(d.get_path('src-arch'), jobs=1)
+    first = prefetcher.prefetch('http://example.com/a.tar.gz', 'a')
+    queued = [prefetcher.prefetch('http://example.com/{}.tar.gz'.format(name), name) for name in ['b', 'c']]
+    assert started.wait(5)
+    # Queued downloads are dropped instead of holding up the exit
+    prefetcher.close(wait=False)
+    assert all(future.cancelled() for future in queued)
+    release.set()
+    assert first.result() == 'http://example.com/a.tar.gz'
+
+def test_prefetch_fetch(d, http_server, monkeypatch):
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    ar = os.path.join(http_server.root, 'libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    url = http_server.url('libsimple.tar.gz')
+    hash = 'sha1:' + cget.util.hash_file(ar, 'sha1')
+    prefix = PrefixForTests(d)
+    prefix.stream_extract = False
+    prefix.cache = cget.cache.ArchiveCache(d.get_path('cache'))
+    prefix.prefetcher = cget.prefetch.Prefetcher(d.get_path('arch'), cache=prefix.cache)
+    builder = cget.builder.Builder(prefix, d.get_path('arch'), d.get_path('src'), d.get_path('build'))
+    prefix.prefetcher.prefetch(url, 'simple', hash=hash)
+    assert os.path.exists(os.path.join(builder.fetch(url, 'simple', hash=hash), 'CMakeLists.txt'))
+    # The prefetched copy isn't kept once the archive is in the cache and the store
+    assert os.listdir(prefix.prefetcher.get_path()) == []
+    # A failed prefetch is downloaded again when the package is fetched
+    retrieve = cget.util.retrieve_url
+    calls = []
+    def flaky(*args, **kwargs):
+        calls.append(args[0])
+        if len(calls) == 1: raise cget.util.BuildError("Download failed")
+        return retrieve(*args, **kwargs)
+    monkeypatch.setattr(cget.util, 'retrieve_url', flaky)
+    prefix.prefetcher.prefetch(url, 'simple2')
+    assert os.path.exists(os.path.join(builder.fetch(url, 'simple2'), 'CMakeLists.txt'))
+    assert calls == [url, url]
+    prefix.prefetcher.close()
+    prefix.jobserver.close()
+
+def test_stream_hash(d, http_server, monkeypatch):
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    ar = os.path.join(http_server.root, 'libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    url = http_server.url('libsimple.tar.gz')
+    prefix = PrefixForTests(d)
+    prefix.cache = cget.cache.ArchiveCache(d.get_path('cache'))
+    builder = cget.builder.Builder(prefix, d.get_path('arch'), d.get_path('src'), d.get_path('build'))
+    bad = 'sha1:' + '0' * 40
+    with pytest.raises(cget.util.BuildError):
+        builder.stream(url, hash=bad)
+    # Nothing is committed unless the digest matches
+    assert not os.path.exists(builder.get_store_path(cget.builder.get_store_key(bad)))
+    assert os.listdir(builder.get_store_path()) == []
+    assert os.listdir(d.get_path('arch')) == ['.store']
+    good = 'SHA1:' + cget.util.hash_file(ar, 'sha1').upper()
+    src = builder.stream(url, hash=good)
+    assert os.path.exists(os.path.join(src, 'CMakeLists.txt'))
+    assert os.path.exists(d.get_path('arch', 'libsimple.tar.gz'))
+    # The cache key doesn't depend on how the hash was spelled
+    assert cget.builder.get_store_key(good) == cget.util.get_hash_key(good.lower())
+    assert prefix.cache.get(cget.util.get_hash_key(good.lower())) is not None
+    prefix.jobserver.close()
+
+def test_hash_file_chunks(d):
+    data = os.urandom(cget.util.CHUNK_SIZE * 2 + 123)
+    f = d.get_path('data.bin')
+    with open(f, 'wb') as fp: fp.write(data)
+    assert cget.util.hash_file(f, 'sha256') == hashlib.sha256(data).hexdigest()
+
+def test_retrieve_url_hash(d, http_server, monkeypatch):
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    ar = os.path.join(http_server.root, 'libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    url = http_server.url('libsimple.tar.gz')
+    with pytest.raises(cget.util.BuildError):
+        cget.util.retrieve_url(url, d.mkdir('bad').tmp_dir, hash='sha1:' + '0' * 40)
+    f = cget.util.retrieve_url(url, d.mkdir('good').tmp_dir, hash='sha1:' + cget.util.hash_file(ar, 'sha1'))
+    assert os.path.exists(f)
+
+def test_cache_lru(d):
+    cache = cget.cache.ArchiveCache(d.get_path('cache'), max_size='2K')
+    for name in ['a', 'b', 'c']:
+        cache.add('sha1-' + name, d.write_to(name + '.tar.gz', ['x' * 1000]))
+        time.sleep(0.01)
+    assert cache.get('sha1-a') is None
+    assert cache.get('sha1-b') is not None
+    cache.add('sha1-d', d.write_to('d.tar.gz', ['x' * 1000]))
+    assert cache.get('sha1-c') is None
+    assert cache.get('sha1-b') is not None
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['bytes_saved'] == 2002
+
+def test_cache_shares_file(d):
+    cache = cget.cache.ArchiveCache(d.get_path('cache'))
+    f = d.write_to('a.tar.gz', ['data'])
+    cached = cache.add('sha1-a', f)
+    assert os.path.samefile(f, cached) or cget.util.hash_file(f, 'sha1') == cget.util.hash_file(cached, 'sha1')
+    target = cget.util.clone_file(cache.get('sha1-a'), d.get_path('b.tar.gz'))
+    with open(target) as fp: assert fp.read() == 'data\n'
+
+def test_download_resume(d, http_server):
+    data = os.urandom(300000)
+    ar = os.path.join(http_server.root, 'data.tar.gz')
+    with open(ar, 'wb') as f: f.write(data)
+    dst = d.mkdir('dst').tmp_dir
+    part = cget.util.get_part_file(http_server.url('data.tar.gz'), dst)
+    with open(part, 'wb') as f: f.write(data[:100000])
+    cget.util.write_to(part + '.validator', [get_test_etag(ar)])
+    h = hashlib.sha1()
+    f = cget.util.download_to(http_server.url('data.tar.gz'), dst, progress=False, hasher=h)
+    assert http_server.server.requests == ['bytes=100000-']
+    assert h.hexdigest() == hashlib.sha1(data).hexdigest()
+    with open(f, 'rb') as fp: assert fp.read() == data
+    assert not os.path.exists(part)
+    assert not os.path.exists(part + '.validator')
+
+def test_download_resume_mismatch(d, http_server):
+    a = b'A' * 1000
+    b = os.urandom(300000)
+    for name, data in [('a', a), ('b', b)]:
+        cget.util.mkdir(os.path.join(http_server.root, name))
+        with open(os.path.join(http_server.root, name, 'HEAD.tar.gz'), 'wb') as f: f.write(data)
+    dst = d.mkdir('dst').tmp_dir
+    # A partial download of another url with the same name isn't resumed
+    part = cget.util.get_part_file(http_server.url('a/HEAD.tar.gz'), dst)
+    with open(part, 'wb') as f: f.write(a[:500])
+    cget.util.write_to(part + '.validator', [get_test_etag(os.path.join(http_server.root, 'a', 'HEAD.tar.gz'))])
+    f = cget.util.download_to(http_server.url('b/HEAD.tar.gz'), dst, progress=False)
+    with open(f, 'rb') as fp: assert fp.read() == b
+    assert http_server.server.requests == [None]
+    # A part file of a url whose content has changed since starts over
+    part = cget.util.get_part_file(http_server.url('b/HEAD.tar.gz'), dst)
+    with open(part, 'wb') as f: f.write(a[:500])
+    cget.util.write_to(part + '.validator', ['"stale"'])
+    h = hashlib.sha1()
+    f = cget.util.download_to(http_server.url('b/HEAD.tar.gz'), dst, progress=False, hasher=h)
+    assert h.hexdigest() == hashlib.sha1(b).hexdigest()
+    with open(f, 'rb') as fp: assert fp.read() == b
+    assert http_server.server.requests[1:] == ['bytes=500-']
+    # Without a validator, nothing is resumed
+    with open(part, 'wb') as f: f.write(a[:500])
+    f = cget.util.download_to(http_server.url('b/HEAD.tar.gz'), dst, progress=False)
+    with open(f, 'rb') as fp: assert fp.read() == b
+    assert http_server.server.requests[2:] == [None]
+
+def test_download_segments(d, http_server):
+    data = os.urandom(cget.util.CHUNK_SIZE * 4 + 1000)
+    with open(os.path.join(http_server.root, 'data.tar.gz'), 'wb') as f: f.write(data)
+    h = hashlib.sha1()
+    f = cget.util.download_to(http_server.url('data.tar.gz'), d.mkdir('dst').tmp_dir, progress=False, hasher=h, segments=4)
+    assert len(http_server.server.requests) == 5
+    assert h.hexdigest() == hashlib.sha1(data).hexdigest()
+    with open(f, 'rb') as fp: assert fp.read() == data
+
+def test_download_keep_alive(d, http_server):
+    for name in ['a', 'b', 'c']:
+        d.write_to(os.path.join(http_server.root, name + '.tar.gz'), [name])
+    pool = cget.util.get_http_pool()
+    connections = pool.connections
+    for name in ['a', 'b', 'c']:
+        f = cget.util.download_to(http_server.url(name + '.tar.gz'), d.mkdir('dst').tmp_dir, progress=False)
+        with open(f) as fp: assert fp.read() == name + '\n'
+    assert pool.connections - connections == 1
+
+@pytest.mark.skipif(os.name != 'posix', reason="Requires symlinks")
+def test_clone_dir(d):
+    src = d.mkdir('src', 'include')
+    h = src.write_to('simple.h', ['#define SIMPLE'])
+    os.symlink('simple.h', src.get_path('alias.h'))
+    d.mkdir('src', 'empty')
+    cget.util.make_read_only(src.tmp_dir)
+    cget.util.clone_dir(d.get_path('src'), d.get_path('dst'))
+    assert os.readlink(d.get_path('dst', 'include', 'alias.h')) == 'simple.h'
+    assert os.path.isdir(d.get_path('dst', 'empty'))
+    # Writing into the clone, even as root, never reaches the store
+    assert not os.path.samefile(h, d.get_path('dst', 'include', 'simple.h'))
+    d.write_to(os.path.join('dst', 'include', 'simple.h'), ['#define PATCHED'])
+    assert open(h).read() == '#define SIMPLE\n'
+
+def test_staging_dir(d):
+    dst = d.get_path('src', 'simple')
+    d.mkdir('src', 'simple').write_to('old.txt', ['old'])
+    with cget.util.staging_dir(dst) as a, cget.util.staging_dir(dst) as b:
+        assert a != b
+        assert os.path.dirname(a) == d.get_path('src')
+        cget.util.mkfile(a, 'new.txt', ['new'])
+        cget.util.replace_dir(a, dst)
+    assert os.listdir(dst) == ['new.txt']
+    assert os.listdir(d.get_path('src')) == ['simple']
+
+def test_extract_zip_parallel(d):
+    ar = d.get_path('libsimple.zip')
+    src = get_exists_path('libsimple')
+    with zipfile.ZipFile(ar, 'w', zipfile.ZIP_DEFLATED) as f:
+        for root, dirs, files in os.walk(src):
+            f.write(root, os.path.relpath(root, os.path.dirname(src)))
+            for file in files:
+                f.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), os.path.dirname(src)))
+    cget.util.extract_ar(ar, d.mkdir('dst').tmp_dir, jobs=4)
+    for root, dirs, files in os.walk(src):
+        for file in files:
+            p = os.path.join(root, file)
+            assert cget.util.hash_file(p, 'sha1') == cget.util.hash_file(d.get_path('dst', os.path.relpath(p, os.path.dirname(src))), 'sha1')
+
+def test_stream_extract(d, http_server):
+    ar = os.path.join(http_server.root, 'libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    h = hashlib.sha1()
+    tee = d.get_path('libsimple.tar.gz')
+    cget.util.stream_extract(http_server.url('libsimple.tar.gz'), d.mkdir('dst').tmp_dir, tee, hasher=h, progress=False)
+    assert h.hexdigest() == cget.util.hash_file(ar, 'sha1')
+    assert cget.util.hash_file(tee, 'sha1') == cget.util.hash_file(ar, 'sha1')
+    assert os.path.exists(d.get_path('dst', 'libsimple', 'CMakeLists.txt'))
+
+def test_extract_filter(d):
+    ar = d.get_path('libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    cget.util.extract_ar(ar, d.mkdir('dst').tmp_dir, select=cget.util.member_filter(exclude=['include', '*.cpp']))
+    assert os.path.exists(d.get_path('dst', 'libsimple', 'CMakeLists.txt'))
+    assert not os.path.exists(d.get_path('dst', 'libsimple', 'include'))
+    assert not os.path.exists(d.get_path('dst', 'libsimple', 'test.cpp'))
+    select = cget.util.member_filter(include=['include'])
+    assert select('libsimple/include/simple.h')
+    assert not select('libsimple/CMakeLists.txt')
+
+def test_parse_pkg_build_filters():
+    pb = cget.package1.parse_pkg_build_tokens(['zlib', '-E', 'doc', '-E', '*.pdf', '-I', 'src'])
+    assert pb.exclude == ['doc', '*.pdf']
+    assert pb.include == ['src']
+
+def test_binary_cache(d):
+    prefix = d.mkdir('prefix').tmp_dir
+    files = [d.get_path('prefix', 'include', 'simple.h'), d.get_path('prefix', 'lib', 'libsimple.a')]
+    for f in files: cget.util.mkfile(os.path.dirname(f), os.path.basename(f), [f])
+    cache = cget.binary.BinaryCache(d.get_path('cache'))
+    cache.save('key', files, prefix)
+    cget.util.mkfile(d.get_path(), 'other', ['other'])
+    assert cache.save('outside', [d.get_path('other')], prefix) is None
+    restored = d.mkdir('restored').tmp_dir
+    assert sorted(cache.restore('key', restored)) == sorted(os.path.join(restored, os.path.relpath(f, prefix)) for f in files)
+    assert open(d.get_path('restored', 'lib', 'libsimple.a')).read().strip() == files[1]
+    assert cache.restore('missing', restored) is None
+
+def test_binary_cache_limit(d):
+    prefix = d.mkdir('prefix').tmp_dir
+    cache = cget.binary.BinaryCache(d.get_path('cache'))
+    for name in ['a', 'b', 'c']:
+        f = cget.util.mkfile(prefix, name, [os.urandom(1000).hex()])
+        cache.save(name, [f], prefix)
+        time.sleep(0.01)
+    cache.set_max_size('3K')
+    assert cache.stats()['entries'] == 2
+    assert cache.restore('a', d.mkdir('restored').tmp_dir) is None
+    assert cache.stats()['max_size'] == 3 * 1024
+
+class BuilderForTests:
+    cmake_original_file = 'original.cmake'
+
+    def __init__(self):
+        self.calls = []
+
+    def configure(self, *args, **kwargs):
+        self.calls.append(('configure', kwargs.get('test')))
+
+    def build(self, *args, **kwargs):
+        self.calls.append(('build', kwargs.get('target')))
+
+    def test(self, *args, **kwargs):
+        self.calls.append(('test', None))
+
+def test_binary_cache_skips_tests(d, monkeypatch):
+    monkeypatch.chdir(d.tmp_dir)
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    prefix = cget.prefix.CGetPrefix({'activeConfig': 'test', 'packages': {}})
+    saved = []
+    monkeypatch.setattr(prefix, 'restore_binary', lambda builder, pb, key: False)
+    monkeypatch.setattr(prefix, 'save_binary', lambda builder, pb, key: saved.append(key))
+    pb = cget.package1.PackageBuild('simple')
+    builder = BuilderForTests()
+    prefix._build_pkg(builder, pb, d.mkdir('src').tmp_dir, source_key='sha256-abc')
+    assert len(saved) == 1
+    # A tree configured with tests on isn't cached for later installs
+    prefix._build_pkg(builder, pb, d.get_path('src'), test=True, source_key='sha256-abc')
+    prefix._build_pkg(builder, pb, d.get_path('src'), test_all=True, source_key='sha256-abc')
+    assert len(saved) == 1
+    assert ('test', None) in builder.calls
+
+def test_binary_fingerprint(d):
+    toolchain = d.get_path('cget.cmake')
+    cget.util.write_to(toolchain, ['set(CGET_PREFIX /usr)'])
+    pb = cget.package1.PackageBuild('zlib', define=['A=1'])
+    key = cget.binary.get_fingerprint('sha256-abc', pb, toolchain)
+    assert key == cget.binary.get_fingerprint('sha256-abc', cget.package1.PackageBuild('zlib', define=['A=1']), toolchain)
+    assert key != cget.binary.get_fingerprint('sha256-abd', pb, toolchain)
+    assert key != cget.binary.get_fingerprint('sha256-abc', cget.package1.PackageBuild('zlib', define=['A=1'], variant='Debug'), toolchain)
+    assert key != cget.binary.get_fingerprint('sha256-abc', cget.package1.PackageBuild('zlib', define=['A=2']), toolchain)
+    cget.util.write_to(toolchain, ['set(CGET_PREFIX /opt)'])
+    assert key != cget.binary.get_fingerprint('sha256-abc', pb, toolchain)
+
+@pytest.fixture
+def cache_server(d):
+    server = cget.remote.CacheServer(d.get_path('remote'))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_remote_binary_cache(d, cache_server):
+    prefix = d.mkdir('prefix').tmp_dir
+    files = [d.get_path('prefix', 'lib', 'libsimple.a')]
+    cget.util.mkfile(d.get_path('prefix', 'lib'), 'libsimple.a', ['simple'])
+    remote = cget.remote.RemoteCache(cache_server.get_url())
+    cget.binary.BinaryCache(d.get_path('cache1'), remote=remote).save('key', files, prefix)
+    assert remote.wait() == 1
+    assert os.path.exists(d.get_path('remote', 'key.tar.gz'))
+    cache = cget.binary.BinaryCache(d.get_path('cache2'), remote=remote)
+    assert cache.restore('key', d.mkdir('restored').tmp_dir) == [d.get_path('restored', 'lib', 'libsimple.a')]
+    assert cache.contains('key')
+    assert cache.restore('missing', d.get_path('restored')) is None
+    # Corrupt uploads are rejected
+    assert not cget.util.can(lambda: cget.util.upload_file(remote.get_url('bad'), files[0], headers={cget.remote.CHECKSUM_HEADER: 'abc'}))
+    assert not os.path.exists(d.get_path('remote', 'bad.tar.gz'))
+
+def test_cache_server_keys(d, cache_server):
+    for key in ['.', '..', '.hidden']: assert not cget.remote.KEY_PATTERN.match(key)
+    assert cget.remote.KEY_PATTERN.match('abc.tar.gz')
+    host, port = cache_server.server_address[:2]
+    for method, path in [('GET', '/..'), ('PUT', '/..'), ('PUT', '/.')]:
+        conn = http_client.HTTPConnection(host, port)
+        conn.request(method, path, body=b'x' if method == 'PUT' else None)
+        assert conn.getresponse().status in [400, 404]
+        conn.close()
+    assert os.listdir(d.get_path()) == ['remote']
+
+def test_remote_cache_unreachable(d):
+    remote = cget.remote.RemoteCache('http://127.0.0.1:1')
+    assert remote.download('key', d.mkdir('dst').tmp_dir) is None
+    cget.util.mkfile(d.get_path(), 'f', ['f'])
+    assert not remote.upload('key', d.get_path('f'))
+
+def test_configure_fingerprint(d, monkeypatch):
+    src = d.get_path('src')
+    cget.util.copy_dir(get_exists_path('libsimple'), src)
+    calls = []
+    def cmake(args, cwd=None):
+        calls.append(args)
+        cget.util.mkfile(cwd, 'CMakeCache.txt', [''])
+    monkeypatch.setattr(cget.cmake, 'cmd', cmake)
+    builder = cget.cmake.CMake(cmake='cmake', install_root=d.get_path('install'))
+    build = d.get_path('build')
+    builder.configure(src_dir=src, build_dir=build, options={})
+    builder.configure(src_dir=src, build_dir=build, options={})
+    assert len(calls) == 1
+    builder.configure(src_dir=src, build_dir=build, options={'define': {'A': '1'}})
+    assert len(calls) == 2
+    with open(os.path.join(src, 'CMakeLists.txt'), 'a') as f: f.write('\n# changed\n')
+    builder.configure(src_dir=src, build_dir=build, options={'define': {'A': '1'}})
+    assert len(calls) == 3
+    os.remove(os.path.join(build, 'CMakeCache.txt'))
+    builder.configure(src_dir=src, build_dir=build, options={'define': {'A': '1'}})
+    assert len(calls) == 4
+
+def test_seed_cache(d):
+    cget.util.write_to(d.get_path('CMakeLists.txt'), [
+        'cmake_minimum_required(VERSION 3.5)',
+        'project(seed C)',
+        'include(CheckIncludeFile)',
+        'include(CheckTypeSize)',
+        'check_include_file(stdio.h HAVE_STDIO_H)',
+        'check_include_file(cget_missing.h HAVE_CGET_MISSING_H)',
+        'check_type_size(int SIZEOF_INT)',
+        'check_type_size(cget_missing_t SIZEOF_CGET_MISSING)'
+    ])
+    seeds = cget.seed.SeedCache(d.get_path('seed'))
+    subprocess.check_output(['cmake', d.get_path()], cwd=d.mkdir('build1').tmp_dir)
+    results = cget.seed.parse_check_results(d.get_path('build1', 'CMakeCache.txt'))
+    assert results['HAVE_SIZEOF_INT'] == 'TRUE'
+    assert results['SIZEOF_INT'] == '4'
+    # Header checks depend on the prefix and failed checks could pass later
+    assert not [k for k in results if 'STDIO' in k or 'CGET_MISSING' in k]
+    seed_file = seeds.update('toolchain', results)
+    assert seeds.load('toolchain') == results
+    assert seeds.update('toolchain', {'SIZEOF_INT': '8'}) == seed_file
+    assert seeds.load('toolchain')['SIZEOF_INT'] == '4'
+    out = subprocess.check_output(['cmake', '-C', seed_file, d.get_path()], cwd=d.mkdir('build2').tmp_dir).decode('utf-8')
+    assert 'size of int' not in out
+    assert 'stdio.h' in out
+    assert cget.seed.parse_check_results(d.get_path('build2', 'CMakeCache.txt')) == results
+
+def test_find_launcher(d, monkeypatch):
+    bin_dir = d.mkdir('bin').tmp_dir
+    monkeypatch.setenv('PATH', bin_dir)
+    assert cget.util.find_launcher('auto') is None
+    assert cget.util.find_launcher('none') is None
+    cget.util.mkfile(bin_dir, 'sccache', ['#!/bin/sh'])
+    assert cget.util.find_launcher('auto') == os.path.join(bin_dir, 'sccache')
+    cget.util.mkfile(bin_dir, 'ccache', ['#!/bin/sh'])
+    assert cget.util.find_launcher('auto') == os.path.join(bin_dir, 'ccache')
+    assert cget.util.find_launcher('sccache') == os.path.join(bin_dir, 'sccache')
+    assert cget.util.get_launcher_name(cget.util.find_launcher('sccache')) == 'sccache'
+
+def test_toolchain_debug_prefix_map(d, monkeypatch):
+    monkeypatch.chdir(d.tmp_dir)
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    bin_dir = d.mkdir('bin').tmp_dir
+    launcher = cget.util.mkfile(bin_dir, 'ccache', ['#!/bin/sh', 'exec "$@"'])
+    os.chmod(launcher, 0o755)
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+    cget.util.mkfile(d.get_path('src'), 'CMakeLists.txt', [
+        'cmake_minimum_required(VERSION 3.5)',
+        'project(flags C CXX)'
+    ])
+    prefix = cget.prefix.CGetPrefix({'activeConfig': 'test', 'packages': {}})
+    def configure(name, launcher):
+        toolchain = prefix.write_cmake(always_write=True, launcher=launcher)
+        subprocess.check_output(['cmake', '-DCMAKE_TOOLCHAIN_FILE=' + toolchain, d.get_path('src')], cwd=d.mkdir(name).tmp_dir)
+        with open(d.get_path(name, 'CMakeCache.txt')) as f:
+            return [line.strip() for line in f if line.startswith(('CMAKE_C_FLAGS:', 'CMAKE_CXX_FLAGS:'))]
+    flag = '-fdebug-prefix-map={}=.'.format(d.tmp_dir)
+    flags = configure('build1', 'ccache')
+    assert len(flags) == 2
+    assert all(line.count(flag) == 1 for line in flags)
+    assert not any(flag in line for line in configure('build2', 'none'))
+
+class PrefixForTests:
+    def __init__(self, d, generator=None):
+        self.toolchain = d.get_path('cget.cmake')
+        self.verbose = False
+        self.generator = generator
+        self.seed_cache = None
+        self.jobserver = cget.jobserver.JobServer(3)
+        self.calls = []
+        self.cmd = self
+
+    def log(self, *args):
+        pass
+
+    def get_default_generator(self):
+        return self.generator
+
+    def cmake(self, args=None, options=None, cwd=None, **kwargs):
+        self.calls.append(args)
+        if '-G' in args:
+            cget.util.mkfile(cwd, 'CMakeCache.txt', ['CMAKE_GENERATOR:INTERNAL=' + args[args.index('-G') + 1]])
+
+def test_builder_generators(d):
+    prefix = PrefixForTests(d, generator='Ninja Multi-Config')
+    builder = cget.builder.Builder(prefix, d.get_path('arch'), d.get_path('src'), d.get_path('build'))
+    builder.configure(d.mkdir('src').tmp_dir, variant='Debug')
+    assert prefix.calls[-1][:2] == ['-G', 'Ninja Multi-Config']
+    assert not any(arg.startswith('-DCMAKE_BUILD_TYPE') for arg in prefix.calls[-1])
+    # Debug and Release share the same configure
+    builder.configure(d.get_path('src'), variant='Release')
+    assert len(prefix.calls) == 1
+    builder.build(variant='Release')
+    assert prefix.calls[-1][-4:] == ['Release', '--', '-j', '3']
+    # A ninja that can join the fifo jobserver doesn't get its own -j
+    ninja = cget.util.mkfile(d.get_path('bin'), 'ninja', ['#!/bin/sh', 'echo 1.13.0'])
+    os.chmod(ninja, 0o755)
+    with open(d.get_path('build', 'CMakeCache.txt'), 'a') as f: f.write('CMAKE_MAKE_PROGRAM:FILEPATH={}\n'.format(ninja))
+    builder.build(variant='Release')
+    assert prefix.calls[-1][-2:] == ['--config', 'Release']
+    assert builder.is_ninja_generator() and not builder.is_make_generator()
+    # Switching the generator starts a new build tree
+    builder.configure(d.get_path('src'), generator='Unix Makefiles', variant='Release')
+    assert '-DCMAKE_BUILD_TYPE=Release' in prefix.calls[-1]
+    assert builder.is_make_generator()
+    prefix.jobserver.close()
+
+def test_header_only_files(d, monkeypatch):
+    monkeypatch.chdir(d.tmp_dir)
+    prefix = cget.prefix.CGetPrefix({'activeConfig': 'test'})
+    src = d.mkdir('src').tmp_dir
+    cget.util.mkfile(d.get_path('src', 'include', 'lib'), 'a.hpp', ['a'])
+    cget.util.mkfile(d.get_path('src', 'include'), 'b.h', ['b'])
+    cget.util.mkfile(d.get_path('src', 'include'), 'notes.txt', ['c'])
+    pb = cget.package1.PackageBuild('lib', cmake=cget.util.cget_dir('cmake', 'header.cmake'))
+    assert prefix.is_header_only(pb)
+    assert not prefix.is_header_only(cget.package1.PackageBuild('lib'))
+    assert prefix.is_header_only(cget.package1.parse_pkg_build_tokens(['lib', '--header-only']))
+    files = prefix.get_header_files(pb, src)
+    assert sorted(files) == [d.get_path('install-test', 'include', 'b.h'), d.get_path('install-test', 'include', 'lib', 'a.hpp')]
+    assert cget.util.copy_files(files) == sorted(files)
+    assert open(d.get_path('install-test', 'include', 'lib', 'a.hpp')).read() == 'a\n'
+    # Headers in the top-level directory
+    cget.util.mkfile(d.get_path('single'), 'c.hxx', ['c'])
+    assert list(prefix.get_header_files(pb, d.get_path('single'))) == [d.get_path('install-test', 'include', 'c.hxx')]
+    # A custom header directory is installed as a subdirectory
+    cget.util.mkfile(d.get_path('custom', 'src', 'lib'), 'e.h', ['e'])
+    pb = cget.package1.PackageBuild('lib', define=['HEADER_DIR=src/lib'], header_only=True)
+    assert list(prefix.get_header_files(pb, d.get_path('custom'))) == [d.get_path('install-test', 'include', 'lib', 'e.h')]
+
+@pytest.mark.parametrize('jobs', [None, 4])
+def test_link_dir(d, jobs):
+    cget.util.mkfile(d.get_path('src', 'include', 'a', 'b'), 'b.h', ['b'])
+    cget.util.mkfile(d.get_path('src', 'lib'), 'libfoo.a', ['foo'])
+    d.mkdir('src', 'share', 'empty')
+    os.symlink('libfoo.a', d.get_path('src', 'lib', 'libfoo.so'))
+    os.symlink('a', d.get_path('src', 'include', 'c'))
+    expected = [os.path.join('include', 'a', 'b', 'b.h'), os.path.join('include', 'c'), os.path.join('lib', 'libfoo.a'), os.path.join('lib', 'libfoo.so')]
+    assert sorted(cget.util.get_link_files(d.get_path('src'))) == expected
+    files = cget.util.symlink_dir(d.get_path('src'), d.get_path('links'), jobs=jobs)
+    assert sorted(files) == [d.get_path('links', f) for f in expected]
+    assert all(os.path.islink(f) for f in files)
+    assert not os.path.exists(d.get_path('links', 'share'))
+    files = cget.util.copy_dir(d.get_path('src'), d.get_path('copy'), jobs=jobs)
+    assert sorted(files) == [d.get_path('copy', f) for f in expected]
+    assert open(d.get_path('copy', 'include', 'a', 'b', 'b.h')).read() == 'b\n'
+    assert os.readlink(d.get_path('copy', 'include', 'c')) == 'a'
+
+@pytest.mark.parametrize('mode', cget.util.LINK_MODES)
+def test_link_tree(d, mode):
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    cget.util.mkdir(d.get_path('src', 'lib'))
+    with open(d.get_path('src', 'lib', 'libfoo.so.1'), 'wb') as f: f.write(data)
+    os.symlink('libfoo.so.1', d.get_path('src', 'lib', 'libfoo.so'))
+    cget.util.mkfile(d.get_path('src', 'include'), 'foo.h', ['foo'])
+    files = cget.util.link_tree(d.get_path('src'), d.get_path('dst'), mode)
+    assert sorted(files) == [d.get_path('dst', 'include', 'foo.h'), d.get_path('dst', 'lib', 'libfoo.so'), d.get_path('dst', 'lib', 'libfoo.so.1')]
+    with open(d.get_path('dst', 'lib', 'libfoo.so.1'), 'rb') as f: assert f.read() == data
+    assert open(d.get_path('dst', 'include', 'foo.h')).read() == 'foo\n'
+    lib = d.get_path('dst', 'lib', 'libfoo.so.1')
+    assert os.path.islink(lib) == (mode == 'symlink')
+    assert os.path.samefile(lib, d.get_path('src', 'lib', 'libfoo.so.1')) == (mode in ['symlink', 'hardlink'])
+    if mode != 'symlink': assert os.readlink(d.get_path('dst', 'lib', 'libfoo.so')) == 'libfoo.so.1'
+
+def test_copy_file(d):
+    data = os.urandom(1024 * 1024 + 3)
+    with open(d.get_path('a'), 'wb') as f: f.write(data)
+    os.chmod(d.get_path('a'), 0o755)
+    cget.util.copy_file(d.get_path('a'), d.get_path('b'))
+    with open(d.get_path('b'), 'rb') as f: assert f.read() == data
+    assert os.stat(d.get_path('b')).st_mode == os.stat(d.get_path('a')).st_mode
+    open(d.get_path('empty'), 'w').close()
+    cget.util.copy_file(d.get_path('empty'), d.get_path('empty2'))
+    assert os.path.getsize(d.get_path('empty2')) == 0
+
+def test_unlink_manifest(d, monkeypatch):
+    monkeypatch.chdir(d.tmp_dir)
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    cget.util.mkfile(d.get_path('pkg', 'include', 'foo'), 'foo.h', ['foo'])
+    create_ar(archive=d.get_path('pkg.tar.gz'), src=d.get_path('pkg'))
+    d.mkdir('src-arch')
+    prefix = cget.prefix.CGetPrefix({'activeConfig': 'test', 'packages': {}})
+    cget.util.mkfile(prefix.get_path('include', 'other'), 'other.h', ['other'])
+    pb = cget.package1.PackageBuild(d.get_path('pkg.tar.gz'), header_only=True)
+    prefix.install(pb)
+    header = prefix.get_path('include', 'foo', 'foo.h')
+    name = prefix.parse_pkg_build(pb).to_fname()
+    pkg_dir = prefix.get_package_directory(name)
+    assert prefix.get_manifest(pkg_dir) == [header]
+    assert prefix.owners.owner(header)[0] == name
+    prefix.unlink(pb)
+    assert not os.path.exists(prefix.get_path('include', 'foo'))
+    assert os.path.exists(prefix.get_path('include', 'other', 'other.h'))
+    assert prefix.owners.owner(header) is None
+    # Linking over a file that isn't from the package fails up front
+    cget.util.mkfile(prefix.get_path('include', 'foo'), 'foo.h', ['other'])
+    assert not cget.util.can(lambda: prefix.link(pb))
+    os.remove(header)
+    prefix.link(pb)
+    assert prefix.owners.owner(header)[0] == name
+    assert open(header).read() == 'foo\n'
+    # Real files can be linked instead of symlinks
+    prefix.unlink(pb)
+    prefix.link_mode = 'hardlink'
+    prefix.link(pb)
+    assert not os.path.islink(header)
+    assert os.path.samefile(header, prefix.get_package_directory(name, 'install', 'include', 'foo', 'foo.h'))
+    prefix.remove(pb)
+    assert not os.path.exists(prefix.get_path('include', 'foo'))
+    assert not os.path.exists(pkg_dir)
+    assert os.path.exists(prefix.get_path('include', 'other', 'other.h'))
+
+def test_fold_link(d, monkeypatch):
+    monkeypatch.chdir(d.tmp_dir)
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    cget.util.mkfile(d.get_path('a', 'include', 'foo'), 'a.h', ['a'])
+    cget.util.mkfile(d.get_path('a', 'include', 'foo', 'sub'), 'x.h', ['x'])
+    cget.util.mkfile(d.get_path('b', 'include', 'foo'), 'b.h', ['b'])
+    create_ar(archive=d.get_path('a.tar.gz'), src=d.get_path('a'))
+    create_ar(archive=d.get_path('b.tar.gz'), src=d.get_path('b'))
+    d.mkdir('src-arch')
+    prefix = cget.prefix.CGetPrefix({'activeConfig': 'test', 'packages': {}})
+    a = cget.package1.PackageBuild(d.get_path('a.tar.gz'), header_only=True)
+    b = cget.package1.PackageBuild(d.get_path('b.tar.gz'), header_only=True)
+    a_name = prefix.parse_pkg_build(a).to_fname()
+    foo = prefix.get_path('include', 'foo')
+    prefix.install(a)
+    prefix.unlink(a)
+    prefix.link(a)
+    # Only the package has include/foo, so it is linked as a whole but include is not
+    assert os.path.islink(foo)
+    assert not os.path.islink(prefix.get_path('include'))
+    assert prefix.get_manifest(prefix.get_package_directory(a_name)) == [foo]
+    assert prefix.owners.owner(os.path.join(foo, 'sub', 'x.h'))[0] == a_name
+    # Installing another package into it unfolds it first
+    prefix.install(b)
+    assert not os.path.islink(foo)
+    assert os.path.islink(os.path.join(foo, 'sub'))
+    assert sorted(prefix.get_manifest(prefix.get_package_directory(a_name))) == [os.path.join(foo, 'a.h'), os.path.join(foo, 'sub')]
+    assert not os.path.exists(prefix.get_unlink_directory(a_name, 'install', 'include', 'foo', 'b.h'))
+    prefix.unlink(b)
+    prefix.unlink(a)
+    assert not os.path.exists(foo)
+    prefix.link(a)
+    assert os.path.islink(foo)
+    # Linking another package into it unfolds it too
+    prefix.link(b)
+    assert not os.path.islink(foo)
+    assert sorted(os.listdir(foo)) == ['a.h', 'b.h', 'sub']
+    assert prefix.owners.owner(os.path.join(foo, 'b.h'))[0] == prefix.parse_pkg_build(b).to_fname()
+    prefix.unlink(a)
+    assert os.listdir(foo) == ['b.h']
+    assert open(os.path.join(foo, 'b.h')).read() == 'b\n'
+
+def test_fold_install(d, monkeypatch):
+    monkeypatch.chdir(d.tmp_dir)
+    monkeypatch.setenv('XDG_CONFIG_HOME', d.get_path('config'))
+    cget.util.mkfile(d.get_path('a', 'include', 'foo'), 'a.h', ['a'])
+    for name, dst in [('c', 'include'), ('e', 'include/foo')]:
+        cget.util.mkfile(d.get_path(name), name + '.h', [name])
+        cget.util.mkfile(d.get_path(name), 'CMakeLists.txt', [
+            'cmake_minimum_required(VERSION 3.5)',
+            'project({} NONE)'.format(name),
+            'install(FILES {}.h DESTINATION {})'.format(name, dst)
+        ])
+    for name in ['a', 'c', 'e']: create_ar(archive=d.get_path(name + '.tar.gz'), src=d.get_path(name))
+    d.mkdir('src-arch')
+    prefix = cget.prefix.CGetPrefix({'activeConfig': 'test', 'packages': {}})
+    a = cget.package1.PackageBuild(d.get_path('a.tar.gz'), header_only=True)
+    e = cget.package1.PackageBuild(d.get_path('e.tar.gz'))
+    foo = prefix.get_path('include', 'foo')
+    e_h = os.path.join(foo, 'e.h')
+    prefix.install(a)
+    prefix.unlink(a)
+    prefix.link(a)
+    assert os.path.islink(foo)
+    # A package that doesn't install into the folded directory leaves it alone
+    prefix.install(d.get_path('c.tar.gz'))
+    assert os.path.islink(foo)
+    assert os.path.isfile(prefix.get_path('include', 'c.h'))
+    # One that does unfolds it and installs into the prefix, not into the other package
+    prefix.install(e)
+    assert not os.path.islink(foo)
+    assert not os.path.islink(e_h)
+    assert open(e_h).read() == 'e\n'
+    assert not os.path.exists(prefix.get_unlink_directory(prefix.parse_pkg_build(a).to_fname(), 'install', 'include', 'foo', 'e.h'))
+    assert prefix.get_manifest(prefix.get_package_directory(prefix.parse_pkg_build(e).to_fname())) == [e_h]
+    # Restoring from the binary cache unfolds it too
+    prefix.remove(e)
+    prefix.unlink(a)
+    prefix.link(a)
+    assert os.path.islink(foo)
+    restored = []
+    restore = prefix.binary_cache.restore
+    monkeypatch.setattr(prefix.binary_cache, 'restore', lambda *args: restored.append(restore(*args)) or restored[-1])
+    os.remove(d.get_path('src-arch', 'e.tar.gz'))
+    prefix.install(e)
+    assert restored == [[e_h]]
+    assert not os.path.islink(foo)
+    assert open(e_h).read() == 'e\n'
+    assert open(os.path.join(foo, 'a.h')).read() == 'a\n'
+    prefix.close()
+
+def test_owner_index(d):
+    prefix = d.mkdir('prefix').tmp_dir
+    cget.util.mkfile(d.get_path('prefix', 'include'), 'a.h', ['a'])
+    cget.util.mkfile(d.get_path('prefix', 'include'), 'b.h', ['b'])
+    owners = cget.owners.OwnerIndex(d.get_path('prefix', 'cget', 'owners.db'), prefix)
+    owners.add('a', ['include/a.h'])
+    assert owners.owner(d.get_path('prefix', 'include', 'a.h')) == ('a', cget.owners.get_content_hash(d.get_path('prefix', 'include', 'a.h')))
+    assert owners.owner('include/b.h') is None
+    assert owners.conflicts('b', ['include/a.h', 'include/b.h', 'include/c.h']) == [('include/a.h', 'a'), ('include/b.h', None)]
+    assert owners.conflicts('a', ['include/a.h']) == []
+    owners.add('b', ['include/a.h', 'include/b.h'])
+    assert owners.owned('a', ['include/a.h', 'include/c.h']) == ['include/c.h']
+    owners.remove('b')
+    assert owners.owner('include/a.h') is None